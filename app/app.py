@@ -1,12 +1,53 @@
-from chat.controller import ChatController
-import gradio as gr
+from chat.personas import Persona, PersonaRegistry
+from chat.startup import Warmup, profile
+import os
+
+with profile.phase("import gradio"):
+    import gradio as gr
 
 # make the chatbot have a better UI
 
+# stream the tokens of the reply into the chat as they arrive
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() != "false"
+# seconds a request waits for the warm-up before it gives up
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", "300"))
+WARMING_UP_MESSAGE = "⏳ Starting up, this takes a moment..."
+
+
+def _create_registry():
+    """
+    Builds the persona registry and the default persona; the models, indexes and clients load
+    here, on the warm-up thread. The other personas load on their first request.
+    """
+    with profile.phase("import chat.controller"):
+        import chat.controller
+    registry = PersonaRegistry()
+    registry.get()
+    return registry
+
+
+def _header(persona: Persona) -> tuple[str, str]:
+    """
+    Renders the title and the sidebar of a persona.
+    """
+    title = f"""
+            # 👋 {persona.full_name}'s AI Assistant
+            {persona.description}
+            """
+    sidebar = f"""
+                    **{persona.full_name}**  
+                    {persona.title}
+                    """
+    return title, sidebar
 
 
 def main():
-    controller = ChatController()
+    # the personas are listed right away, their controllers are built in the background
+    personas = Persona.discover(PersonaRegistry.PERSONAS_DIR)
+    default = personas.get(PersonaRegistry.DEFAULT_PERSONA) or personas[Persona.DEFAULT_ID]
+    warmup = Warmup(_create_registry, name="warmup")
+    warmup.start()
+    title, sidebar = _header(default)
 
     with gr.Blocks(theme=gr.themes.Monochrome(), css="""
 .gradio-container { background: #181a20 !important; }
@@ -14,58 +55,67 @@ def main():
 .gr-chatbot { background: #23262f !important; }
 .gr-textbox textarea { background: #23262f !important; color: #e0e0e0 !important; }
 """) as ui:
-        gr.Markdown(
-            """
-            # 👋 Diego Araque's AI Assistant
-            Welcome! Ask me anything about Diego's professional background, projects, or experience.
-            """,
-            elem_id="main-title"
-        )
+        header = gr.Markdown(title, elem_id="main-title")
         with gr.Row():
             with gr.Column(scale=1, min_width=120):
-                gr.Image(
-                    value="https://media.licdn.com/dms/image/v2/D4D03AQEmLX_SGf-wBQ/profile-displayphoto-shrink_800_800/B4DZbGu7chG8Ac-/0/1747090914455?e=1756339200&v=beta&t=a-Wg3VIb8VcfauNnoyuMdAd-w1HO8wvPwTRNJmZ9Q0Y",  # Replace with Diego's avatar if available
+                avatar = gr.Image(
+                    value=default.avatar,
                     show_label=False,
                     show_download_button=False,
                     height=100,
                     width=100,
                 )
-                gr.Markdown(
-                    """
-                    **Diego Araque**  
-                    Software Engineer | Capital One, Tec de Monterrey
-                    [LinkedIn](https://www.linkedin.com/in/diegoaraque21/)
-                    """,
-                    elem_id="sidebar-info"
-                )
+                info = gr.Markdown(sidebar, elem_id="sidebar-info")
             with gr.Column(scale=4):
                 chat = gr.Chatbot(
                     type="messages",
                     min_height=400,
-                    label="💬 Chat with Diego's AI",
+                    label="💬 Chat",
                     bubble_full_width=False,
                 )
                 msg = gr.Textbox(
                     label="Your message",
-                    placeholder="Ask about Diego's skills, experience, or projects...",
+                    placeholder="Ask about skills, experience, or projects...",
                     autofocus=True,
                     submit_btn=True
                 )
                 history_state = gr.State([])
                 emails_sent = gr.State([])
+                # the persona of the session, chosen with ?persona=<id> in the URL
+                persona_state = gr.State(default.id)
+
+                def select_persona(request: gr.Request):
+                    persona = personas.get(request.query_params.get("persona")) if request else None
+                    persona = persona or default
+                    title, sidebar = _header(persona)
+                    return persona.id, title, sidebar, persona.avatar
 
                 def add_user_message(message, history):
                     history.append({"role": "user", "content": message})
                     return history, history
 
-                def respond(history, emails_state):
+                async def respond(history, emails_state, persona_id):
                     message = history[-1]["content"]
-                    reply, emails = controller.get_response(msg=message, history=history, emails_sent=set(emails_state))
-                    history.append({"role": "assistant", "content": reply})
-                    return history, list(emails)
+                    if not warmup.ready:
+                        # readiness gate, the first requests wait for the warm-up to finish
+                        yield history + [{"role": "assistant", "content": WARMING_UP_MESSAGE}], emails_state
+                    registry = await warmup.await_ready(READY_TIMEOUT)
+                    controller = await registry.aget(persona_id)
+                    if not STREAM_RESPONSES:
+                        reply, emails = await controller.aget_response(msg=message, history=history, emails_sent=set(emails_state))
+                        history.append({"role": "assistant", "content": reply})
+                        yield history, list(emails)
+                        return
+
+                    # stream the tokens into the chat, a rejected reply is replaced by the retry
+                    conversation = list(history)
+                    history.append({"role": "assistant", "content": ""})
+                    async for reply, emails in controller.astream_response(msg=message, history=conversation, emails_sent=set(emails_state)):
+                        history[-1]["content"] = reply
+                        yield history, list(emails)
 
                 msg.submit(add_user_message, inputs=[msg, history_state], outputs=[history_state, chat])
-                msg.submit(respond, inputs=[history_state, emails_sent], outputs=[chat, emails_sent])
+                msg.submit(respond, inputs=[history_state, emails_sent, persona_state], outputs=[chat, emails_sent])
                 msg.submit(lambda: "", None, msg)
 
         gr.Markdown(
@@ -77,4 +127,9 @@ def main():
             elem_id="footer"
         )
 
+        ui.load(select_persona, inputs=None, outputs=[persona_state, header, info, avatar])
+
+    # async handlers do not hold a worker thread while waiting, so allow many sessions at once
+    ui.queue(default_concurrency_limit=int(os.getenv("GRADIO_CONCURRENCY", "32")))
+    profile.mark("ui built")
     ui.launch(share=True)
\ No newline at end of file
@@ -0,0 +1,181 @@
+"""
+Compares the int8 ONNX embedding backend with the PyTorch model it was exported from.
+
+    python -m benchmarks.bench_embeddings
+    python -m benchmarks.bench_embeddings --concurrency 16 --queries 400 --json results.json
+
+Both backends embed the chunks of the knowledge directory and the questions of
+benchmarks/questions.json. Parity is reported as the cosine similarity between the vectors of
+the two backends and as the overlap of the top-k chunks of every question, for a store embedded
+with the ONNX model and for the existing PyTorch store queried with ONNX vectors (what a switch
+without re-ingesting gives). Hit rate uses the expected terms of the question file.
+
+Every backend is measured in its own process so the RSS numbers do not mix: load time, memory,
+single query latency with the query cache off, query throughput from concurrent threads (where
+the micro-batching applies) and document throughput.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+QUESTIONS_FILE = os.path.join(os.path.dirname(__file__), "questions.json")
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+BACKENDS = ("huggingface", "onnx")
+
+
+def _memory_mb() -> float:
+    import psutil
+
+    return psutil.Process().memory_info().rss / 2**20
+
+
+def _chunks(knowledge_dir: str, splitter: str) -> list[str]:
+    """
+    Splits the knowledge base the way the ingestion does.
+    """
+    from chat.ingest import build_splitter, iter_knowledge_files, splitter_config
+
+    text_splitter = build_splitter(splitter_config(splitter))
+    chunks = []
+    for source in iter_knowledge_files(knowledge_dir):
+        with open(source, "rb") as f:
+            chunks.extend(text_splitter.split_text(f.read().decode("utf-8", errors="replace")))
+    return list(dict.fromkeys(chunks))
+
+
+def measure(backend: str, args, out_path: str) -> dict:
+    """
+    Loads one backend, embeds the corpus and the questions and times it, runs in a child process.
+    The vectors are written to out_path for the parity check.
+    :return: the measurements
+    """
+    # every query of the latency run has to reach the model
+    os.environ["EMBEDDING_QUERY_CACHE"] = "0"
+    from chat.embeddings import load_embeddings
+
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = [item["question"] for item in json.load(f)]
+    chunks = _chunks(args.knowledge_dir, args.splitter)
+
+    before = _memory_mb()
+    start = time.perf_counter()
+    embedding = load_embeddings(args.model_name, backend)
+    embedding.embed_query("warm-up")
+    load_s = time.perf_counter() - start
+    loaded = _memory_mb()
+
+    start = time.perf_counter()
+    documents = np.asarray(embedding.embed_documents(chunks), dtype=np.float32)
+    documents_s = time.perf_counter() - start
+    queries = np.asarray([embedding.embed_query(question) for question in questions], dtype=np.float32)
+
+    texts = [f"{questions[i % len(questions)]} ({i})" for i in range(args.queries)]
+    latencies = []
+    for text in texts:
+        start = time.perf_counter()
+        embedding.embed_query(text)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(embedding.embed_query, [f"{text} [concurrent]" for text in texts]))
+    concurrent_s = time.perf_counter() - start
+
+    np.savez(out_path, documents=documents, queries=queries)
+    return {
+        "backend": backend,
+        "load_s": round(load_s, 2),
+        "model_rss_mb": round(loaded - before, 1),
+        "peak_rss_mb": round(_memory_mb(), 1),
+        "query_p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "query_p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "concurrent_qps": round(len(texts) / concurrent_s, 1),
+        "documents_per_s": round(len(chunks) / documents_s, 1) if documents_s else 0.0,
+        "stats": dict(getattr(embedding, "stats", {})),
+    }
+
+
+def _top_k(queries: np.ndarray, documents: np.ndarray, k: int) -> np.ndarray:
+    return np.argsort(-(queries @ documents.T), axis=1)[:, :k]
+
+
+def _overlap(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.mean([len(set(x) & set(y)) / len(x) for x, y in zip(a, b)]))
+
+
+def _hit_rate(top: np.ndarray, chunks: list[str], expected: list[list[str]]) -> float:
+    hits = 0
+    for indexes, terms in zip(top, expected):
+        terms = [term.lower() for term in terms]
+        hits += any(term in chunks[i].lower() for i in indexes for term in terms)
+    return hits / max(len(expected), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default=QUESTIONS_FILE)
+    parser.add_argument("--knowledge-dir", default="knowledge")
+    parser.add_argument("--splitter", choices=("sentence", "token"), default="sentence")
+    parser.add_argument("--model-name", default=MODEL_NAME)
+    parser.add_argument("-k", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200, help="queries of the latency and throughput runs")
+    parser.add_argument("--concurrency", type=int, default=8, help="threads of the throughput run")
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--out", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args, args.out)))
+        return
+
+    root = tempfile.mkdtemp(prefix="bench_embeddings_")
+    results, vectors = {}, {}
+    for backend in BACKENDS:
+        out_path = os.path.join(root, f"{backend}.npz")
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_embeddings", "--child", backend, "--out", out_path,
+             "--questions", args.questions, "--knowledge-dir", args.knowledge_dir, "--splitter", args.splitter,
+             "--model-name", args.model_name, "--queries", str(args.queries), "--concurrency", str(args.concurrency)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results[backend] = json.loads(output.strip().splitlines()[-1])
+        vectors[backend] = np.load(out_path)
+
+    with open(args.questions, "r", encoding="utf-8") as f:
+        expected = [item.get("expected", []) for item in json.load(f)]
+    chunks = _chunks(args.knowledge_dir, args.splitter)
+    reference, onnx = vectors["huggingface"], vectors["onnx"]
+    top_reference = _top_k(reference["queries"], reference["documents"], args.k)
+    top_onnx = _top_k(onnx["queries"], onnx["documents"], args.k)
+    top_mixed = _top_k(onnx["queries"], reference["documents"], args.k)
+    parity = {
+        "document_cosine_mean": round(float(np.mean(np.sum(reference["documents"] * onnx["documents"], axis=1))), 4),
+        "query_cosine_min": round(float(np.min(np.sum(reference["queries"] * onnx["queries"], axis=1))), 4),
+        f"overlap@{args.k}": round(_overlap(top_reference, top_onnx), 3),
+        f"overlap@{args.k}_mixed": round(_overlap(top_reference, top_mixed), 3),
+        f"hit@{args.k}_huggingface": round(_hit_rate(top_reference, chunks, expected), 3),
+        f"hit@{args.k}_onnx": round(_hit_rate(top_onnx, chunks, expected), 3),
+    }
+
+    columns = ["backend", "load_s", "model_rss_mb", "query_p50_ms", "query_p95_ms", "concurrent_qps", "documents_per_s"]
+    print(" | ".join(f"{column:>15}" for column in columns))
+    for result in results.values():
+        print(" | ".join(f"{result[column]!s:>15}" for column in columns))
+    for name, value in parity.items():
+        print(f"{name:<28} {value}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results, "parity": parity}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Compares dense, BM25 and hybrid (reciprocal rank fusion) retrieval on a fixed question set.
+
+    python -m benchmarks.bench_hybrid
+    python -m benchmarks.bench_hybrid --questions my_questions.json -k 4 --json results.json
+
+The question file is a list of {"question": ..., "expected": [...]}; a question counts as a hit
+when one of its top-k chunks contains one of the expected terms (case insensitive). Reports hit
+rate, mean reciprocal rank and search latency. Query embeddings are computed before the timer
+starts, the time of the embedding itself is reported separately.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from chat.rag import RAG
+from chat.bm25 import BM25Index
+
+QUESTIONS_FILE = os.path.join(os.path.dirname(__file__), "questions.json")
+
+
+def _first_hit(chunks: list[str], expected: list[str]) -> int | None:
+    """
+    Returns the rank of the first chunk that contains an expected term.
+    """
+    terms = [term.lower() for term in expected]
+    for rank, chunk in enumerate(chunks, start=1):
+        text = chunk.lower()
+        if any(term in text for term in terms):
+            return rank
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", default=QUESTIONS_FILE)
+    parser.add_argument("--persist-dir", default="chroma_store")
+    parser.add_argument("--knowledge-dir", default="knowledge")
+    parser.add_argument("--backend", choices=("chroma", "numpy"), default="chroma")
+    parser.add_argument("-k", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=20, help="times every question is searched for the latency")
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    args = parser.parse_args()
+
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = json.load(f)
+
+    rag = RAG(persist_dir=args.persist_dir, knowledge_dir=args.knowledge_dir, backend=args.backend, hybrid=True)
+
+    start = time.perf_counter()
+    bm25 = BM25Index.load(rag.store_dir)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    embeddings = [rag.embed_query(item["question"]) for item in questions]
+    embed_ms = (time.perf_counter() - start) * 1000 / len(questions)
+
+    modes = {
+        "dense": lambda query, embedding: [
+            doc.page_content for doc in rag.vstores.similarity_search_by_vector(embedding, k=args.k)
+        ],
+        "bm25": lambda query, embedding: [text for _, text, _ in bm25.search(query, args.k)],
+        "hybrid": lambda query, embedding: rag._hybrid_search(query, embedding, args.k),
+    }
+
+    results = []
+    for mode, search in modes.items():
+        hits = 0
+        reciprocal_ranks = []
+        latencies = []
+        for item, embedding in zip(questions, embeddings):
+            rank = _first_hit(search(item["question"], embedding), item["expected"])
+            hits += rank is not None
+            reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                search(item["question"], embedding)
+                latencies.append((time.perf_counter() - start) * 1000)
+        results.append({
+            "mode": mode,
+            f"hit@{args.k}": round(hits / len(questions), 3),
+            "mrr": round(float(np.mean(reciprocal_ranks)), 3),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        })
+
+    print(f"{len(questions)} questions, {len(bm25)} chunks, BM25 load {load_ms:.2f} ms, query embedding {embed_ms:.2f} ms")
+    columns = list(results[0])
+    print(" | ".join(f"{column:>8}" for column in columns))
+    for result in results:
+        print(" | ".join(f"{result[column]!s:>8}" for column in columns))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "questions": len(questions),
+                "chunks": len(bm25),
+                "bm25_load_ms": round(load_ms, 3),
+                "embed_ms": round(embed_ms, 3),
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
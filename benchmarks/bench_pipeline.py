@@ -0,0 +1,242 @@
+"""
+Benchmarks the whole ChatController pipeline offline.
+
+    python -m benchmarks.bench_pipeline
+    python -m benchmarks.bench_pipeline --concurrency 8 --repeat 3 --reject-rate 0.3 --json run.json
+
+OpenAI and Gemini are replaced by a local OpenAI-compatible server (benchmarks/fake_openai.py)
+with configurable latency, token rate and evaluator rejection rate, and Mongo by a mongomock
+collection (pip install mongomock). The embedding model, the vector store and everything else
+are the real ones.
+
+The multi-turn conversations of the workload file are replayed through get_response, a number of
+them at a time, and every turn counts as a request. The run is reproducible with the same seed.
+Reports the latency percentiles, throughput, retries per request, tokens sent to each model and
+the time spent in each stage. Stages nest: chat includes its tool calls and evaluate includes
+the remote evaluation. The knowledge base is ingested into a temporary store unless --persist-dir
+is given, so the run never changes the app's store.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.fake_openai import FakeBehaviour, FakeOpenAIServer
+
+WORKLOAD_FILE = os.path.join(os.path.dirname(__file__), "workload.json")
+
+
+# class that records the time spent in each stage of the current request
+class StageTimer:
+    def __init__(self):
+        self._local = threading.local()
+
+    def begin(self):
+        self._local.stages = {}
+
+    def end(self) -> dict:
+        stages = getattr(self._local, "stages", {})
+        self._local.stages = {}
+        return stages
+
+    def wrap(self, owner, method: str, stage: str):
+        """
+        Replaces a method of an object with a version that records its time under a stage.
+        """
+        func = getattr(owner, method)
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stages = getattr(self._local, "stages", None)
+                if stages is not None:
+                    entry = stages.setdefault(stage, {"calls": 0, "seconds": 0.0})
+                    entry["calls"] += 1
+                    entry["seconds"] += time.perf_counter() - start
+
+        setattr(owner, method, timed)
+
+
+def _instrument(controller, timer: StageTimer):
+    timer.wrap(controller.rag, "embed_query", "embed")
+    timer.wrap(controller.cache, "get", "cache")
+    timer.wrap(controller.rag, "get_relevant_chunks", "retrieve")
+    timer.wrap(controller.chatbot, "chat", "chat")
+    timer.wrap(controller.chatbot, "_handle_tool_usage", "tools")
+    timer.wrap(controller.chatbot, "retry", "retry")
+    timer.wrap(controller.evaluator, "evaluate", "evaluate")
+    remote = getattr(controller.evaluator, "evaluator", None)
+    if remote is not None:
+        # the grounding pre-check wraps the remote evaluator
+        timer.wrap(remote, "evaluate", "remote_evaluate")
+
+
+def _percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    return {
+        "p50_ms": round(float(np.percentile(values, 50)) * 1000, 2),
+        "p95_ms": round(float(np.percentile(values, 95)) * 1000, 2),
+        "p99_ms": round(float(np.percentile(values, 99)) * 1000, 2),
+        "mean_ms": round(float(np.mean(values)) * 1000, 2),
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workload", default=WORKLOAD_FILE)
+    parser.add_argument("--concurrency", type=int, default=4, help="conversations replayed at the same time")
+    parser.add_argument("--repeat", type=int, default=1, help="times the workload is replayed")
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds to the first token of a chat reply")
+    parser.add_argument("--token-rate", type=float, default=80.0, help="generated tokens per second")
+    parser.add_argument("--evaluator-latency", type=float, default=0.2, help="seconds per evaluator call")
+    parser.add_argument("--reject-rate", type=float, default=0.1, help="fraction of evaluations that reject the reply")
+    parser.add_argument("--ungrounded-rate", type=float, default=0.05, help="fraction of chat replies that are made up")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests refused with 429")
+    parser.add_argument("--no-cache", action="store_true", help="disable the answer cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--knowledge-dir", default="knowledge", help="the knowledge base ingested for the run")
+    parser.add_argument("--persist-dir", default=None,
+                        help="the vector store of the run, a new temporary one by default so the app's store is not touched")
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    args = parser.parse_args()
+
+    with open(args.workload, "r", encoding="utf-8") as f:
+        workload = json.load(f)
+
+    behaviour = FakeBehaviour(
+        latency=args.latency,
+        token_rate=args.token_rate,
+        evaluator_latency=args.evaluator_latency,
+        reject_rate=args.reject_rate,
+        ungrounded_rate=args.ungrounded_rate,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    server = FakeOpenAIServer(behaviour)
+    server.start()
+
+    # the clients read these when their modules are imported, so they are set first
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    os.environ["GEMINI_BASE_URL"] = server.base_url
+    os.environ.setdefault("OPENAI_API_KEY", "offline")
+    os.environ.setdefault("GOOGLE_API_KEY", "offline")
+    if args.no_cache:
+        os.environ["SEMANTIC_CACHE_SIZE"] = "0"
+    # the pipeline is measured, not the provider rate limits, unless they are set explicitly
+    for variable in ("OPENAI_REQUESTS_PER_SECOND", "OPENAI_BURST", "GEMINI_REQUESTS_PER_SECOND", "GEMINI_BURST"):
+        os.environ.setdefault(variable, "1000")
+
+    import mongomock
+    from chat.clients import provider_stats
+    from chat.tools import lead_store
+    from chat.controller import ChatController
+    from chat.personas import Persona
+
+    # pin the endpoints in case a .env file loaded by the chat modules overrode them
+    from chat.chat import Chatbot
+    from chat.evaluator import Evaluator
+    Chatbot.OPENAI_BASE_URL = server.base_url
+    Evaluator.BASE_URL = server.base_url
+
+    lead_store.collection = mongomock.MongoClient().benchmark.leads
+    # the default persona, but on its own copy of the store
+    persona = Persona.default()
+    persona.knowledge_dir = args.knowledge_dir
+    persona.persist_dir = args.persist_dir or tempfile.mkdtemp(prefix="bench_pipeline_")
+    controller = ChatController(persona)
+    timer = StageTimer()
+    _instrument(controller, timer)
+
+    requests = []
+    requests_lock = threading.Lock()
+
+    def replay(conversation: dict):
+        history = []
+        emails = set()
+        for message in conversation["turns"]:
+            history.append({"role": "user", "content": message})
+            timer.begin()
+            start = time.perf_counter()
+            reply, emails = controller.get_response(msg=message, history=history, emails_sent=emails)
+            elapsed = time.perf_counter() - start
+            stages = timer.end()
+            history.append({"role": "assistant", "content": reply})
+            with requests_lock:
+                requests.append({"conversation": conversation["id"], "seconds": elapsed, "stages": stages})
+
+    conversations = [conversation for _ in range(args.repeat) for conversation in workload]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(replay, conversations))
+    wall = time.perf_counter() - start
+    lead_store.flush()
+    server.stop()
+
+    stage_names = sorted({name for request in requests for name in request["stages"]})
+    stages = {}
+    for name in stage_names:
+        seconds = [request["stages"].get(name, {}).get("seconds", 0.0) for request in requests]
+        calls = [request["stages"].get(name, {}).get("calls", 0) for request in requests]
+        stages[name] = {"calls_per_request": round(float(np.mean(calls)), 3), **_percentiles(seconds)}
+
+    model_stats = behaviour.snapshot()
+    results = {
+        "commit": _git_commit(),
+        "config": vars(args),
+        "requests": len(requests),
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(requests) / wall, 3) if wall else 0.0,
+        "latency": _percentiles([request["seconds"] for request in requests]),
+        "retries_per_request": stages.get("retry", {}).get("calls_per_request", 0.0),
+        "tokens_sent": {model: entry["prompt_tokens"] for model, entry in model_stats.items()},
+        "tokens_sent_per_request": round(sum(entry["prompt_tokens"] for entry in model_stats.values()) / max(len(requests), 1), 1),
+        "models": model_stats,
+        "stages": stages,
+        "policy": dict(controller.policy.stats),
+        "cache": dict(controller.cache.stats),
+        "grounding": dict(getattr(controller.evaluator, "stats", {})),
+        "leads": dict(lead_store.stats),
+        "http": provider_stats(),
+        "refused_by_server": behaviour.refused,
+    }
+
+    latency = results["latency"]
+    print(
+        f"{results['requests']} requests in {results['wall_s']}s, {results['throughput_rps']} req/s, "
+        f"p50 {latency['p50_ms']} ms, p95 {latency['p95_ms']} ms, p99 {latency['p99_ms']} ms"
+    )
+    print(f"retries per request {results['retries_per_request']}, tokens sent per request {results['tokens_sent_per_request']}")
+    for name, stats in results["http"].items():
+        print(
+            f"{name}: {stats['requests']} http requests, {stats['retries']} retried, {stats['coalesced']} coalesced, "
+            f"{stats['throttled_seconds']:.2f}s throttled"
+        )
+    print(f"{'stage':<16} {'calls/req':>9} {'p50_ms':>9} {'p95_ms':>9} {'mean_ms':>9}")
+    for name, stage in stages.items():
+        print(f"{name:<16} {stage['calls_per_request']:>9} {stage['p50_ms']:>9} {stage['p95_ms']:>9} {stage['mean_ms']:>9}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
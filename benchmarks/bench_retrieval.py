@@ -0,0 +1,184 @@
+"""
+Compares query latency and memory of the retrieval backends.
+
+    python -m benchmarks.bench_retrieval                      # the knowledge/ directory, real model
+    python -m benchmarks.bench_retrieval --synthetic 50000    # random vectors, no model needed
+    python -m benchmarks.bench_retrieval --json results.json
+
+Every backend is measured in its own process so the RSS numbers do not mix. Query vectors are
+computed before the timer starts, so only the search itself is measured.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+QUESTIONS_FILE = os.path.join(os.path.dirname(__file__), "questions.json")
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+DIMENSION = 384
+
+
+# class that returns random unit vectors, stands in for the model with --synthetic
+class RandomEmbeddings:
+    def __init__(self, seed: int = 0):
+        self.rng = np.random.default_rng(seed)
+
+    def embed_documents(self, texts):
+        vectors = self.rng.normal(size=(len(texts), DIMENSION)).astype(np.float32)
+        return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def _store_dirs(root: str) -> dict:
+    return {
+        "chroma": os.path.join(root, "chroma"),
+        "numpy": os.path.join(root, "numpy"),
+        "numpy-int8": os.path.join(root, "numpy-int8"),
+    }
+
+
+def prepare(root: str, synthetic: int, batch_size: int = 512):
+    """
+    Builds the same corpus in every backend.
+    :param root: folder for the stores
+    :param synthetic: number of random chunks, 0 to ingest the knowledge directory
+    :return: None
+    """
+    from langchain_community.vectorstores import Chroma
+    from chat.vector_index import NumpyVectorIndex
+
+    dirs = _store_dirs(root)
+    if synthetic:
+        chroma = Chroma(persist_directory=dirs["chroma"], embedding_function=RandomEmbeddings(1))
+        for path in (dirs["numpy"], dirs["numpy-int8"]):
+            os.makedirs(os.path.join(path, "numpy_index"), exist_ok=True)
+        stores = [
+            NumpyVectorIndex(os.path.join(dirs["numpy"], "numpy_index"), RandomEmbeddings(1)),
+            NumpyVectorIndex(os.path.join(dirs["numpy-int8"], "numpy_index"), RandomEmbeddings(1), quantize=True),
+        ]
+        for start in range(0, synthetic, batch_size):
+            count = min(batch_size, synthetic - start)
+            ids = [f"{i:032d}" for i in range(start, start + count)]
+            texts = [f"synthetic chunk {i}" for i in range(start, start + count)]
+            metadatas = [{"source": "synthetic"} for _ in ids]
+            # every store gets the same vectors because the generators share the seed
+            chroma.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+            for store in stores:
+                store.add_texts(texts=texts, metadatas=metadatas, ids=ids)
+        for store in stores:
+            store.save()
+        return
+
+    from chat.rag import RAG
+
+    RAG(persist_dir=dirs["chroma"], model_name=MODEL_NAME, backend="chroma")
+    RAG(persist_dir=dirs["numpy"], model_name=MODEL_NAME, backend="numpy")
+    RAG(persist_dir=dirs["numpy-int8"], model_name=MODEL_NAME, backend="numpy", quantize=True)
+
+
+def _memory() -> dict:
+    import psutil
+
+    info = psutil.Process().memory_full_info()
+    return {"rss": info.rss, "uss": info.uss}
+
+
+def measure(backend: str, root: str, synthetic: int, queries: int, k: int) -> dict:
+    """
+    Opens one backend and times the searches, runs in a child process.
+    :return: the measurements
+    """
+    from langchain_community.vectorstores import Chroma
+    from chat.vector_index import NumpyVectorIndex
+
+    if synthetic:
+        embedding = RandomEmbeddings(2)
+        vectors = [embedding.embed_query("") for _ in range(queries)]
+    else:
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        embedding = HuggingFaceEmbeddings(model_name=MODEL_NAME)
+        with open(QUESTIONS_FILE, "r", encoding="utf-8") as f:
+            questions = json.load(f)
+        vectors = [embedding.embed_query(questions[i % len(questions)]["question"]) for i in range(queries)]
+
+    path = _store_dirs(root)[backend]
+    before = _memory()
+    start = time.perf_counter()
+    if backend == "chroma":
+        store = Chroma(persist_directory=path, embedding_function=embedding)
+    else:
+        store = NumpyVectorIndex(os.path.join(path, "numpy_index"), embedding)
+    open_ms = (time.perf_counter() - start) * 1000
+
+    # first query warms caches and pages, it is reported on its own
+    start = time.perf_counter()
+    store.similarity_search_by_vector(vectors[0], k=k)
+    first_ms = (time.perf_counter() - start) * 1000
+
+    latencies = []
+    for vector in vectors:
+        start = time.perf_counter()
+        store.similarity_search_by_vector(vector, k=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    after = _memory()
+
+    return {
+        "backend": backend,
+        "open_ms": round(open_ms, 2),
+        "first_query_ms": round(first_ms, 3),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        "rss_delta_mb": round((after["rss"] - before["rss"]) / 2**20, 2),
+        "uss_delta_mb": round((after["uss"] - before["uss"]) / 2**20, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--synthetic", type=int, default=0, help="number of random chunks instead of the knowledge base")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=4)
+    parser.add_argument("--dir", default=None, help="reuse the stores in this folder instead of a temporary one")
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = measure(args.child, args.dir, args.synthetic, args.queries, args.k)
+        print(json.dumps(result))
+        return
+
+    root = args.dir or tempfile.mkdtemp(prefix="bench_retrieval_")
+    if not os.path.exists(_store_dirs(root)["numpy"]) or not args.dir:
+        prepare(root, args.synthetic)
+
+    results = []
+    for backend in _store_dirs(root):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_retrieval", "--child", backend, "--dir", root,
+             "--synthetic", str(args.synthetic), "--queries", str(args.queries), "-k", str(args.k)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    columns = ["backend", "open_ms", "first_query_ms", "p50_ms", "p95_ms", "p99_ms", "rss_delta_mb", "uss_delta_mb"]
+    print(" | ".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print(" | ".join(f"{result[column]!s:>14}" for column in columns))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"synthetic": args.synthetic, "queries": args.queries, "k": args.k, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
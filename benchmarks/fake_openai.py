@@ -0,0 +1,263 @@
+"""
+Local OpenAI-compatible server for the offline benchmarks, standing in for OpenAI and Gemini.
+
+It answers POST /v1/chat/completions, streamed or not, after a configurable delay and at a
+configurable token rate:
+- replies are built from the context chunks in the prompt, so the grounding pre-check
+  accepts them, except for a configurable fraction of made-up replies
+- a message carrying an email address gets a record_user_details tool call first
+- requests with a response_format are evaluator calls; they reject a configurable fraction
+  of the replies
+- a configurable fraction of all requests is refused with 429, as a rate-limited provider would
+
+Token counts use the same tokenizer as the prompt budgeting.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from chat.prompt import PromptBuilder
+
+EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+CONTEXT = re.compile(r"Use ONLY the following context to answer:\n(.*?)\n\nRemember:", re.DOTALL)
+CHUNK_NUMBER = re.compile(r"^\[\d+\]\s*", re.MULTILINE)
+FILLER = (
+    "Diego once sailed around the world on a wooden boat and won several international "
+    "chess tournaments while composing symphonies for a national orchestra."
+)
+
+
+# class that holds the knobs and the counters of the fake server
+class FakeBehaviour:
+    def __init__(
+        self,
+        latency: float = 0.3,
+        token_rate: float = 80.0,
+        evaluator_latency: float = 0.2,
+        reject_rate: float = 0.1,
+        ungrounded_rate: float = 0.05,
+        reply_tokens: int = 120,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        """
+        :param latency: seconds before the first token of a chat reply
+        :param token_rate: tokens per second of the generated text
+        :param evaluator_latency: seconds before an evaluator answer
+        :param reject_rate: fraction of the evaluations that reject the reply
+        :param ungrounded_rate: fraction of the chat replies that are made up
+        :param reply_tokens: maximum length of a chat reply
+        :param error_rate: fraction of the requests refused with 429 Too Many Requests
+        :param seed: seed of the random choices, runs with the same seed make the same choices
+        """
+        self.latency = latency
+        self.token_rate = token_rate
+        self.evaluator_latency = evaluator_latency
+        self.reject_rate = reject_rate
+        self.ungrounded_rate = ungrounded_rate
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.prompt_builder = PromptBuilder()
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.refused = 0
+
+    def chance(self, rate: float) -> bool:
+        with self.lock:
+            return self.rng.random() < rate
+
+    def refuse(self):
+        with self.lock:
+            self.refused += 1
+
+    def record(self, model: str, prompt_tokens: int, completion_tokens: int):
+        with self.lock:
+            entry = self.stats.setdefault(model, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0})
+            entry["requests"] += 1
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+
+def _text(content) -> str:
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+def _chat_reply(behaviour: FakeBehaviour, messages: list) -> str:
+    """
+    Builds a reply from the context of the last user message, or from the rejected reply on retries.
+    """
+    last = _text(messages[-1].get("content")) if messages else ""
+    match = CONTEXT.search(last)
+    source = CHUNK_NUMBER.sub("", match.group(1)) if match else ""
+    if not source:
+        retry = re.search(r"The assistant's reply was: (.*?)\n\s*The user's message was", last, re.DOTALL)
+        source = retry.group(1) if retry else ""
+    if not source or behaviour.chance(behaviour.ungrounded_rate):
+        source = FILLER
+    return behaviour.prompt_builder.truncate(" ".join(source.split()), behaviour.reply_tokens).rstrip(".") + "."
+
+
+def _tool_call(messages: list) -> dict | None:
+    """
+    Asks to record the email of the last user message, once per turn.
+    """
+    if not messages or any(message.get("role") == "tool" for message in messages):
+        return None
+    user_messages = [message for message in messages if message.get("role") == "user"]
+    match = EMAIL.search(_text(user_messages[-1].get("content"))) if user_messages else None
+    if match is None:
+        return None
+    return {
+        "id": f"call_{uuid.uuid4().hex[:24]}",
+        "type": "function",
+        "function": {"name": "record_user_details", "arguments": json.dumps({"email": match.group(0)})},
+    }
+
+
+# class that handles the requests of the fake server
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    behaviour: FakeBehaviour = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        behaviour = self.behaviour
+        if behaviour.chance(behaviour.error_rate):
+            behaviour.refuse()
+            self._send_error_json(429, "Rate limit reached, please retry.")
+            return
+        model = body.get("model", "")
+        messages = body.get("messages", [])
+        prompt_tokens = sum(behaviour.prompt_builder.count(_text(message.get("content"))) for message in messages)
+
+        tool_call = None
+        if body.get("response_format"):
+            time.sleep(behaviour.evaluator_latency)
+            good = not behaviour.chance(behaviour.reject_rate)
+            content = json.dumps({
+                "is_good_response": good,
+                "feedback": "Acceptable." if good else "The reply should stick to the facts in the context.",
+            })
+        else:
+            tool_call = _tool_call(messages) if body.get("tools") else None
+            content = "" if tool_call else _chat_reply(behaviour, messages)
+            time.sleep(behaviour.latency)
+        completion_tokens = behaviour.prompt_builder.count(content) if content else 8
+        behaviour.record(model, prompt_tokens, completion_tokens)
+
+        if body.get("stream"):
+            self._stream(model, content, tool_call, behaviour, completion_tokens)
+        else:
+            if not body.get("response_format"):
+                time.sleep(completion_tokens / behaviour.token_rate)
+            self._complete(model, content, tool_call, prompt_tokens, completion_tokens)
+
+    def _send_json(self, payload: dict):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error_json(self, status: int, message: str):
+        data = json.dumps({"error": {"message": message, "type": "rate_limit_error", "code": None}}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _complete(self, model: str, content: str, tool_call: dict | None, prompt_tokens: int, completion_tokens: int):
+        message = {"role": "assistant", "content": content or None}
+        if tool_call:
+            message["tool_calls"] = [tool_call]
+        self._send_json({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": message,
+                "finish_reason": "tool_calls" if tool_call else "stop",
+                "logprobs": None,
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+    def _stream(self, model: str, content: str, tool_call: dict | None, behaviour: FakeBehaviour, completion_tokens: int):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def send(delta: dict, finish_reason: str | None = None):
+            chunk = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason, "logprobs": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        if tool_call:
+            send({"role": "assistant", "tool_calls": [dict(tool_call, index=0)]})
+            send({}, "tool_calls")
+        else:
+            words = content.split(" ")
+            # the words are spread so the whole text takes as long as its tokens at the token rate
+            delay = completion_tokens / behaviour.token_rate / max(len(words), 1)
+            for i, word in enumerate(words):
+                send({"role": "assistant", "content": word if i == 0 else f" {word}"})
+                time.sleep(delay)
+            send({}, "stop")
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+# class that runs the fake server on a background thread
+class FakeOpenAIServer:
+    def __init__(self, behaviour: FakeBehaviour, host: str = "127.0.0.1", port: int = 0):
+        handler = type("Handler", (FakeOpenAIHandler,), {"behaviour": behaviour})
+        self.behaviour = behaviour
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-openai", daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,188 @@
+import os
+import re
+
+import numpy as np
+
+# terms keep inner dots, dashes, plus and hash signs so "c++", "c#", "node.js" or "ci-cd" survive
+TOKEN = re.compile(r"[a-z0-9]+(?:[.\-+#][a-z0-9+#]+)*[+#]*")
+STOPWORDS = frozenset(
+    "a an and are as at be by do does for from has have he her his how i in is it its me my of on or "
+    "our she that the their them they this to was we were what when where which who why will with you your "
+    "s t d ll re ve m".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Splits a text into lowercase terms without stopwords.
+    :param text: the text
+    :return: list of terms
+    """
+    return [term for term in TOKEN.findall(text.lower()) if term not in STOPWORDS]
+
+
+# class that implements a BM25 inverted index
+class BM25Index:
+    """
+    Okapi BM25 over the chunks of the knowledge base, for the exact-term questions
+    (company names, tools, certifications) that dense search misses.
+    Postings are kept in flat arrays (CSR layout: one offsets array per term into
+    the chunk rows and term frequencies) and persisted in a single uncompressed .npz,
+    so loading is a handful of array reads.
+    """
+    FILE_NAME = "bm25.npz"
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.terms = {}
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.postings = np.zeros(0, dtype=np.int32)
+        self.frequencies = np.zeros(0, dtype=np.uint16)
+        self.doc_lengths = np.zeros(0, dtype=np.int32)
+        self.ids = np.zeros(0, dtype="S32")
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.texts = np.zeros(0, dtype=np.uint8)
+        self._norms = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory of the index arrays, with a rough estimate for the vocabulary.
+        """
+        arrays = (self.indptr, self.postings, self.frequencies, self.doc_lengths, self.ids, self.offsets, self.texts)
+        return sum(array.nbytes for array in arrays) + len(self.terms) * 100
+
+    @classmethod
+    def build(cls, ids: list[str], texts: list[str]) -> "BM25Index":
+        """
+        Builds the index over the chunks.
+        :param ids: the chunk ids
+        :param texts: the chunk texts
+        :return: the index
+        """
+        index = cls()
+        postings = {}
+        doc_lengths = []
+        for row, text in enumerate(texts):
+            terms = tokenize(text)
+            doc_lengths.append(len(terms))
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                postings.setdefault(term, []).append((row, min(count, 65535)))
+
+        vocabulary = sorted(postings)
+        index.terms = {term: i for i, term in enumerate(vocabulary)}
+        index.indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        index.indptr[1:] = np.cumsum([len(postings[term]) for term in vocabulary])
+        flat = [entry for term in vocabulary for entry in postings[term]]
+        index.postings = np.array([row for row, _ in flat], dtype=np.int32)
+        index.frequencies = np.array([count for _, count in flat], dtype=np.uint16)
+        index.doc_lengths = np.array(doc_lengths, dtype=np.int32)
+        index.ids = np.array(ids, dtype="S32")
+        encoded = [text.encode("utf-8") for text in texts]
+        index.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        index.offsets[1:] = np.cumsum([len(text) for text in encoded])
+        index.texts = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return index
+
+    def save(self, persist_dir: str):
+        """
+        Writes the index next to the vector store, atomically.
+        :param persist_dir: the folder of the vector store
+        :return: None
+        """
+        path = os.path.join(persist_dir, self.FILE_NAME)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            vocabulary=np.array(sorted(self.terms, key=self.terms.get), dtype=str),
+            indptr=self.indptr,
+            postings=self.postings,
+            frequencies=self.frequencies,
+            doc_lengths=self.doc_lengths,
+            ids=self.ids,
+            offsets=self.offsets,
+            texts=self.texts,
+            params=np.array([self.k1, self.b]),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, persist_dir: str) -> "BM25Index | None":
+        """
+        Loads the index saved next to the vector store.
+        :param persist_dir: the folder of the vector store
+        :return: the index, or None if it was never built
+        """
+        path = os.path.join(persist_dir, cls.FILE_NAME)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            k1, b = data["params"]
+            index = cls(k1=float(k1), b=float(b))
+            index.terms = {term: i for i, term in enumerate(data["vocabulary"].tolist())}
+            index.indptr = data["indptr"]
+            index.postings = data["postings"]
+            index.frequencies = data["frequencies"]
+            index.doc_lengths = data["doc_lengths"]
+            index.ids = data["ids"]
+            index.offsets = data["offsets"]
+            index.texts = data["texts"]
+        return index
+
+    def _text(self, row: int) -> str:
+        return bytes(self.texts[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+
+    def search(self, query: str, k: int = 4) -> list[tuple[str, str, float]]:
+        """
+        Scores the chunks against the query terms.
+        :param query: the query
+        :param k: number of chunks to return
+        :return: list of (chunk id, text, score), best first; chunks without any query term are left out
+        """
+        n = len(self)
+        if n == 0:
+            return []
+        if self._norms is None:
+            # length normalisation of every chunk, it only depends on the index
+            average_length = max(float(self.doc_lengths.mean()), 1.0)
+            self._norms = (self.k1 * (1 - self.b + self.b * self.doc_lengths / average_length)).astype(np.float32)
+        norms = self._norms
+        scores = np.zeros(n, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.terms.get(term)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            rows = self.postings[start:end]
+            frequencies = self.frequencies[start:end].astype(np.float32)
+            idf = np.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * frequencies * (self.k1 + 1) / (frequencies + norms[rows])
+
+        matched = np.flatnonzero(scores)
+        if len(matched) == 0:
+            return []
+        k = min(k, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[row].decode("ascii"), self._text(row), float(scores[row])) for row in top]
+
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[str]:
+    """
+    Merges rankings by summing 1 / (k + rank) for every list a key appears in.
+    :param rankings: lists of keys, best first
+    :param k: damping constant, 60 is the usual value
+    :return: the fused ranking
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+
+import numpy as np
+
+# class that caches approved replies by the meaning of the question
+class SemanticCache:
+    """
+    Cache of evaluator-approved replies keyed on the query embedding.
+    A new question hits the cache when its cosine similarity with a cached question is
+    above the threshold. Entries expire after a TTL, the least recently used entry is
+    evicted when the cache is full and everything is dropped when the knowledge base changes.
+    """
+    MAX_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "256"))
+    TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+    THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+
+    def __init__(self, max_size: int = MAX_SIZE, ttl: float = TTL, threshold: float = THRESHOLD):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.version = None
+        self._entries = OrderedDict()
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def validate(self, version: str):
+        """
+        Drops every entry when the knowledge base version differs from the cached one.
+        :param version: the current version of the knowledge base
+        :return: None
+        """
+        with self._lock:
+            if version != self.version:
+                if self._entries:
+                    self.stats["invalidations"] += 1
+                self._entries.clear()
+                self.version = version
+
+    def get(self, embedding) -> str | None:
+        """
+        Looks up a reply for a question.
+        :param embedding: the embedding of the question
+        :return: the cached reply, or None on a miss
+        """
+        vector = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (_, _, created) in self._entries.items() if now - created > self.ttl]
+            for key in expired:
+                del self._entries[key]
+            self.stats["expirations"] += len(expired)
+
+            if self._entries:
+                keys = list(self._entries)
+                matrix = np.stack([self._entries[key][0] for key in keys])
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._entries.move_to_end(keys[best])
+                    self.stats["hits"] += 1
+                    return self._entries[keys[best]][1]
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, embedding, reply: str):
+        """
+        Stores an approved reply for a question.
+        :param embedding: the embedding of the question
+        :param reply: the approved reply
+        :return: None
+        """
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._entries[self._next_key] = (vector, reply, time.monotonic())
+            self._next_key += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        """
+        Drops every entry.
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,8 +1,14 @@
 from dotenv import load_dotenv
 import json
-from openai import OpenAI
+import re
+from openai.types.chat import ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion_message_tool_call import Function
 import os
-from chat.tools import _record_user_details, _get_user_details
+from chat.clients import get_provider
+from chat.prompt import PromptBuilder
+from chat.telemetry import telemetry
+from chat.tool_executor import ToolExecutor
+from chat.tools import _record_user_details
 
 load_dotenv(override=True)
 
@@ -36,20 +42,62 @@ TOOL_FUNCTIONS = {
     "record_user_details": _record_user_details
 }
 
+# seconds each tool may take before the model gets a timeout error, other tools use TOOL_TIMEOUT
+TOOL_TIMEOUTS = {
+    "record_user_details": 5
+}
+
 # list of tools that the chatbot can use
 TOOLS_LIST = [{"type": "function", "function": record_user_details_json}]
 
+# splits a reply into sentences and list items
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
+# sentences that only acknowledge a tool call or keep the conversation going
+ACKNOWLEDGEMENT = re.compile(
+    r"thank|record|saved|noted|email|contact|reach out|get back|in touch|follow up|anything else|help you|"
+    r"let me know|feel free|happy to|glad to|sorry|unable|could(n't| not)|try again",
+    re.IGNORECASE,
+)
+# replies longer than this are answers even when every sentence looks like an acknowledgement
+ACKNOWLEDGEMENT_MAX_WORDS = 60
+
+
+def is_acknowledgement(reply: str | None) -> bool:
+    """
+    Tells whether a reply only acknowledges a tool call, so there is nothing in it to evaluate.
+    :param reply: the reply
+    :return: True if every sentence of a short reply is an acknowledgement
+    """
+    if not reply or len(reply.split()) > ACKNOWLEDGEMENT_MAX_WORDS:
+        return False
+    sentences = [sentence.strip() for sentence in SENTENCE_SPLIT.split(reply) if sentence.strip()]
+    return all(ACKNOWLEDGEMENT.search(sentence) for sentence in sentences)
+
 # class that implements the chatbot
 class Chatbot:
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+    # None means the default OpenAI endpoint
+    OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
     MODEL = "gpt-4o-mini"
     TOOLS_LIST = TOOLS_LIST
 
-    def __init__(self):
+    def __init__(self, system_prompt: str | None = None, tool_executor: ToolExecutor | None = None):
+        """
+        :param system_prompt: the system prompt of the persona, None for Diego's
+        :param tool_executor: a tool executor to share between chatbots, a new one by default
+        """
         self.TOOLS = self.TOOLS_LIST
-        self.client = OpenAI(api_key=self.OPENAI_API_KEY)
+        self.system_prompt = system_prompt
+        # pooled clients shared by every Chatbot, with the rate limit and retries of OpenAI
+        provider = get_provider("openai", self.OPENAI_API_KEY, self.OPENAI_BASE_URL)
+        self.client = provider.client
+        self.async_client = provider.async_client
+        self.prompt_builder = PromptBuilder(model=self.MODEL)
+        self.tool_executor = tool_executor or ToolExecutor(TOOL_FUNCTIONS, TOOL_TIMEOUTS)
 
     def _get_system_prompt(self):
+        if self.system_prompt is not None:
+            return self.system_prompt
         return (
             """
             You are Diego Araque, speaking directly through your personal website.
@@ -82,97 +130,293 @@ class Chatbot:
             Remember: It is better to say "I don't know" than to provide incorrect information, but you should confidently and persuasively summarize Diego’s value wherever the context supports it.
         """
         )
-    def _handle_tool_usage(self, tool_calls: list, recorded_emails: list) -> list[str]:
+
+    def _track_recorded_emails(self, results: dict, recorded_emails: set):
+        """
+        Adds the emails that were recorded for the first time in this turn.
+        Emails that the lead store already knew are not added.
+        :param results: the result of every distinct tool call, by (tool name, arguments)
+        :param recorded_emails: set of emails that have been recorded
+        :return: None
+        """
+        for (name, arguments), result in results.items():
+            if name == "record_user_details" and isinstance(result, dict) and result.get("status") == "success":
+                recorded_emails.add(json.loads(arguments)["email"])
+
+    def _handle_tool_usage(self, tool_calls: list, recorded_emails: set) -> list[dict]:
         """
         Handles the usage of tools by the chatbot.
-        If the tool is not already recorded, it records the user's details.
-        If the tool is already recorded, it returns a message saying that the email has already been recorded.
+        Duplicate calls run once and the distinct ones run concurrently, see ToolExecutor.
         :param tool_calls: list of tool calls
         :param recorded_emails: set of emails that have been recorded
-        :return: list of results
-        """
-        results = []
-        for tool_call in tool_calls:
-            tool_name = tool_call.function.name
-            arguments = json.loads(tool_call.function.arguments)   
-            users_recorded = _get_user_details(arguments["email"])
-            if not users_recorded or arguments["email"] not in users_recorded["email"]:
-                func = TOOL_FUNCTIONS[tool_name]
-                result = func(**arguments)
-                results.append({
-                    "role": "tool",
-                    "content": json.dumps(result),
-                    "tool_call_id": tool_call.id,
-                })
-                recorded_emails.add(arguments["email"])
-            else:
-                results.append({
-                    "role": "tool",
-                    "content": "Email recorded successfully, we will contact you shortly.",
-                    "tool_call_id": tool_call.id,
-                })
-        return results
+        :return: list of tool messages, in the order of the calls
+        """
+        with telemetry.span("tools", calls=len(tool_calls)):
+            messages, results = self.tool_executor.run(tool_calls)
+        self._track_recorded_emails(results, recorded_emails)
+        return messages
 
-    def chat(self, msg: str, history: list, emails_sent: list, relevant_chunks: str) -> tuple[str, list]:
+    async def _ahandle_tool_usage(self, tool_calls: list, recorded_emails: set) -> list[dict]:
         """
-        Generates a response from the chatbot.
+        Async version of _handle_tool_usage.
+        :param tool_calls: list of tool calls
+        :param recorded_emails: set of emails that have been recorded
+        :return: list of tool messages, in the order of the calls
+        """
+        with telemetry.span("tools", calls=len(tool_calls)):
+            messages, results = await self.tool_executor.arun(tool_calls)
+        self._track_recorded_emails(results, recorded_emails)
+        return messages
+
+    @staticmethod
+    def _report_turn(turn: dict | None, tool_calls: int, reply: str | None):
+        """
+        Fills the caller's turn dictionary: the number of tool calls the turn ran and whether
+        the reply is only their acknowledgement, in which case it does not need an evaluation.
+        :param turn: the dictionary to fill, or None when the caller does not need it
+        :param tool_calls: the number of tool calls that ran
+        :param reply: the final reply
+        :return: None
         """
+        if turn is not None:
+            turn["tool_calls"] = tool_calls
+            turn["tool_only"] = tool_calls > 0 and is_acknowledgement(reply)
+
+    def _get_context_message(self, relevant_chunks: str) -> str:
+        """
+        Formats the retrieved chunks for the prompt.
+        :param relevant_chunks: the chunks retrieved from the knowledge base
+        :return: the context instruction
+        """
+        # deduplicated chunks within the context budget
+        context = self.prompt_builder.format_chunks(relevant_chunks)
+
         # If no relevant chunks found, explicitly tell the model
-        if not relevant_chunks:
-            context_message = "NO_RELEVANT_INFORMATION_FOUND"
-        else:
-            context_message = f"Use ONLY the following context to answer:\n{relevant_chunks}"
-        
+        if not context:
+            return "NO_RELEVANT_INFORMATION_FOUND"
+        return f"Use ONLY the following context to answer:\n{context}"
+
+    def _get_chat_messages(self, msg: str, history: list, relevant_chunks: str) -> list:
+        """
+        Builds the messages sent to the model for a new user message.
+        :param msg: the message from the user
+        :param history: the history of the conversation
+        :param relevant_chunks: the chunks retrieved from the knowledge base
+        :return: list of messages
+        """
+        context_message = self._get_context_message(relevant_chunks)
+
         # Add explicit instruction about context
         enhanced_msg = f"{msg}\n\n{context_message}\n\nRemember: If the context doesn't contain the answer, say 'I don't have enough information to answer that.'"
         
-        messages = [{"role": "system", "content": self._get_system_prompt()}] + history + [{"role": "user", "content": enhanced_msg}]
+        # recent turns verbatim, older ones summarised, within the token budget
+        return self.prompt_builder.chat_messages(self._get_system_prompt(), history, msg, enhanced_msg)
+
+    def _get_retry_messages(self, reply: str, msg: str, history: list, feedback: str, relevant_chunks: str | None = None) -> list:
+        """
+        Builds the messages sent to the model when a reply was rejected.
+        :param reply: the chatbot's response
+        :param msg: the message from the user
+        :param history: the history of the conversation
+        :param feedback: the feedback from the evaluator
+        :param relevant_chunks: the chunks the reply was built from, so the new one can be grounded in them
+        :return: list of messages
+        """
+        # the conversation is already in the messages, trimmed to the budget, so it is not repeated here
+        updated_prompt = f"""
+        Previous answer was rejected, please try again.
+        The evaluator's feedback was: {feedback}
+        The assistant's reply was: {reply}
+        The user's message was: {msg}
+        Please generate a new reply that addresses the user's feedback.
+        """
+        if relevant_chunks is not None:
+            updated_prompt += f"\n{self._get_context_message(relevant_chunks)}\n"
+
+        return self.prompt_builder.chat_messages(self._get_system_prompt(), history, msg, updated_prompt)
+
+    def chat(self, msg: str, history: list, emails_sent: list, relevant_chunks: str, turn: dict | None = None) -> tuple[str, list]:
+        """
+        Generates a response from the chatbot.
+        :param turn: optional dictionary that gets the tool calls of the turn, see _report_turn
+        """
+        messages = self._get_chat_messages(msg, history, relevant_chunks)
         done = False
+        tool_count = 0
 
         while not done:
-            response = self.client.chat.completions.create(
-                model=self.MODEL,
-                messages=messages,
-                tools=self.TOOLS,
-                max_tokens=500
-            )
+            with telemetry.span("llm.chat", model=self.MODEL) as span:
+                response = self.client.chat.completions.create(
+                    model=self.MODEL,
+                    messages=messages,
+                    tools=self.TOOLS,
+                    max_tokens=500
+                )
+                telemetry.record_usage(self.MODEL, response.usage, span)
 
             finish_reason = response.choices[0].finish_reason
 
             if finish_reason == "tool_calls":
                 tool_calls = response.choices[0].message.tool_calls
+                tool_count += len(tool_calls)
                 tool_results = self._handle_tool_usage(tool_calls, emails_sent)
                 messages.append(response.choices[0].message)
                 messages.extend(tool_results)
             else:
                 done = True
-    
+
+        self._report_turn(turn, tool_count, response.choices[0].message.content)
+        return response.choices[0].message.content, emails_sent
+
+    async def achat(self, msg: str, history: list, emails_sent: list, relevant_chunks: str, turn: dict | None = None) -> tuple[str, list]:
+        """
+        Async version of chat, it does not block the event loop while waiting for the model.
+        """
+        messages = self._get_chat_messages(msg, history, relevant_chunks)
+        done = False
+        tool_count = 0
+
+        while not done:
+            with telemetry.span("llm.chat", model=self.MODEL) as span:
+                response = await self.async_client.chat.completions.create(
+                    model=self.MODEL,
+                    messages=messages,
+                    tools=self.TOOLS,
+                    max_tokens=500
+                )
+                telemetry.record_usage(self.MODEL, response.usage, span)
+
+            finish_reason = response.choices[0].finish_reason
+
+            if finish_reason == "tool_calls":
+                tool_calls = response.choices[0].message.tool_calls
+                tool_count += len(tool_calls)
+                tool_results = await self._ahandle_tool_usage(tool_calls, emails_sent)
+                messages.append(response.choices[0].message)
+                messages.extend(tool_results)
+            else:
+                done = True
+
+        self._report_turn(turn, tool_count, response.choices[0].message.content)
         return response.choices[0].message.content, emails_sent
             
-    def retry(self, reply: str, msg: str, history: list, feedback: str) -> str:
+    @staticmethod
+    def _assemble_tool_calls(partial_calls: dict) -> list:
+        """
+        Builds the tool calls from the fragments received in the stream deltas.
+        :param partial_calls: dictionary from the index of the call to its accumulated id, name and arguments
+        :return: list of tool calls
+        """
+        return [
+            ChatCompletionMessageToolCall(
+                id=call["id"],
+                type="function",
+                function=Function(name=call["name"], arguments=call["arguments"]),
+            )
+            for _, call in sorted(partial_calls.items())
+        ]
+
+    async def astream_chat(self, msg: str, history: list, emails_sent: list, relevant_chunks: str, turn: dict | None = None):
+        """
+        Streams a response from the chatbot, yielding the text deltas as they arrive.
+        Tool calls are assembled from the deltas and executed before the stream continues.
+        The recorded emails are added to emails_sent, and turn is filled once the stream ends.
+        """
+        messages = self._get_chat_messages(msg, history, relevant_chunks)
+        done = False
+        tool_count = 0
+
+        while not done:
+            # the span covers the whole stream, first token to last
+            with telemetry.span("llm.chat", model=self.MODEL, stream=True) as span:
+                stream = await self.async_client.chat.completions.create(
+                    model=self.MODEL,
+                    messages=messages,
+                    tools=self.TOOLS,
+                    max_tokens=500,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+
+                content = []
+                partial_calls = {}
+                finish_reason = None
+                async for chunk in stream:
+                    # the last chunk carries the usage and no choices
+                    telemetry.record_usage(self.MODEL, getattr(chunk, "usage", None), span)
+                    if not chunk.choices:
+                        continue
+                    choice = chunk.choices[0]
+                    delta = choice.delta
+                    if delta.content:
+                        content.append(delta.content)
+                        yield delta.content
+                    for tool_delta in delta.tool_calls or []:
+                        call = partial_calls.setdefault(tool_delta.index, {"id": "", "name": "", "arguments": ""})
+                        if tool_delta.id:
+                            call["id"] = tool_delta.id
+                        if tool_delta.function and tool_delta.function.name:
+                            call["name"] += tool_delta.function.name
+                        if tool_delta.function and tool_delta.function.arguments:
+                            call["arguments"] += tool_delta.function.arguments
+                    if choice.finish_reason:
+                        finish_reason = choice.finish_reason
+
+            if finish_reason == "tool_calls" and partial_calls:
+                tool_calls = self._assemble_tool_calls(partial_calls)
+                tool_count += len(tool_calls)
+                tool_results = await self._ahandle_tool_usage(tool_calls, emails_sent)
+                messages.append({
+                    "role": "assistant",
+                    "content": "".join(content) or None,
+                    "tool_calls": [tool_call.model_dump() for tool_call in tool_calls],
+                })
+                messages.extend(tool_results)
+            else:
+                done = True
+
+        self._report_turn(turn, tool_count, "".join(content))
+
+    def retry(self, reply: str, msg: str, history: list, feedback: str, relevant_chunks: str | None = None) -> str:
         """
         Retries the chatbot's response if it is not acceptable.
         :param reply: the chatbot's response
         :param msg: the message from the user
         :param history: the history of the conversation
         :param feedback: the feedback from the evaluator
-        :return: the new response
+        :param relevant_chunks: the chunks retrieved for the message
+        :return: the new response, the previous one when the model returned no text
         """
-        updated_prompt = f"""
-        Previous answer was rejected, please try again.
-        The evaluator's feedback was: {feedback}
-        The assistant's reply was: {reply}
-        The user's message was: {msg}
-        The assistant's history was: {history}
-        Please generate a new reply that addresses the user's feedback.
+        messages = self._get_retry_messages(reply, msg, history, feedback, relevant_chunks)
+        with telemetry.span("retry", model=self.MODEL) as span:
+            # no tools on a retry, its reply must be text; the first reply already ran the tools of the turn
+            response = self.client.chat.completions.create(
+                model=self.MODEL,
+                messages=messages,
+                max_tokens=500,
+            )
+            telemetry.record_usage(self.MODEL, response.usage, span)
+
+        return response.choices[0].message.content or reply
+
+    async def aretry(self, reply: str, msg: str, history: list, feedback: str, relevant_chunks: str | None = None) -> str:
+        """
+        Async version of retry.
+        :param reply: the chatbot's response
+        :param msg: the message from the user
+        :param history: the history of the conversation
+        :param feedback: the feedback from the evaluator
+        :param relevant_chunks: the chunks retrieved for the message
+        :return: the new response, the previous one when the model returned no text
         """
+        messages = self._get_retry_messages(reply, msg, history, feedback, relevant_chunks)
+        with telemetry.span("retry", model=self.MODEL) as span:
+            # no tools on a retry, its reply must be text; the first reply already ran the tools of the turn
+            response = await self.async_client.chat.completions.create(
+                model=self.MODEL,
+                messages=messages,
+                max_tokens=500,
+            )
+            telemetry.record_usage(self.MODEL, response.usage, span)
 
-        messages = [{"role": "system", "content": self._get_system_prompt()}] + history + [{"role": "user", "content": updated_prompt}]
-        response = self.client.chat.completions.create(
-            model=self.MODEL,
-            messages=messages,
-            tools=self.TOOLS,
-            max_tokens=500,
-        )
-        
-        return response.choices[0].message.content
\ No newline at end of file
+        return response.choices[0].message.content or reply
@@ -0,0 +1,401 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import httpx
+from openai import AsyncOpenAI, OpenAI
+
+from chat.telemetry import telemetry
+
+logger = logging.getLogger(__name__)
+
+# responses that are worth retrying after a pause
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# network errors that happen before the provider saw the request, so it is safe to send it again;
+# a dropped connection after the request was sent may have been billed, so it is not retried
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+# requests per second and burst allowed for each provider
+PROVIDER_LIMITS = {
+    "openai": (float(os.getenv("OPENAI_REQUESTS_PER_SECOND", "8")), int(os.getenv("OPENAI_BURST", "16"))),
+    "gemini": (float(os.getenv("GEMINI_REQUESTS_PER_SECOND", "4")), int(os.getenv("GEMINI_BURST", "8"))),
+}
+
+HTTP_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", "20")),
+    keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30")),
+)
+HTTP_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+BACKOFF_CAP = float(os.getenv("LLM_BACKOFF_CAP", "8"))
+# seconds a coalesced request waits for the one in flight before sending its own
+FLIGHT_WAIT = HTTP_TIMEOUT
+
+
+# class that limits the request rate to a provider
+class TokenBucket:
+    """
+    Token bucket shared by the sync and async clients of a provider. A request that finds the
+    bucket empty reserves the next token and sleeps until it is due, so waiting requests keep
+    their order instead of all retrying at once.
+    """
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """
+        Takes a token, possibly one that is not there yet.
+        :return: seconds to wait before using it
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self) -> float:
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self) -> float:
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+
+def backoff_delay(attempt: int, response: httpx.Response | None = None) -> float:
+    """
+    Pause before a retry: the provider's Retry-After when it sent one, else exponential backoff with full jitter.
+    :param attempt: the number of the attempt that failed, from 0
+    :param response: the failed response, if there was one
+    :return: seconds to wait
+    """
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return min(float(retry_after), BACKOFF_CAP)
+            except ValueError:
+                pass
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+# class that holds one request in flight and the response it got
+class _Flight:
+    def __init__(self, is_async: bool):
+        self.event = asyncio.Event() if is_async else threading.Event()
+        # status, headers and raw body of a complete successful response, None otherwise
+        self.result = None
+
+    def response_for(self, request: httpx.Request) -> httpx.Response:
+        status_code, headers, raw = self.result
+        return httpx.Response(status_code, headers=headers, stream=httpx.ByteStream(raw), request=request)
+
+
+# class that records the raw body of a streamed response as it is read
+class _TeeStream(httpx.SyncByteStream):
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+        self._chunks = []
+        self._complete = False
+
+    def __iter__(self):
+        for chunk in self._stream:
+            self._chunks.append(chunk)
+            yield chunk
+        self._complete = True
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            self._on_close(b"".join(self._chunks) if self._complete else None)
+
+
+# class that records the raw body of a streamed response as it is read, async version
+class _AsyncTeeStream(httpx.AsyncByteStream):
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+        self._chunks = []
+        self._complete = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            self._chunks.append(chunk)
+            yield chunk
+        self._complete = True
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._on_close(b"".join(self._chunks) if self._complete else None)
+
+
+# class that holds the shared connection pools and limits of one provider
+class Provider:
+    """
+    Everything the clients of one provider share: the keep-alive connection pools, the token
+    bucket, the retry policy and the requests in flight.
+
+    Identical requests (same method, URL and body) that are in flight at the same time are sent
+    once; the others wait and get a copy of the response. In practice these are the first turns
+    of different sessions asking the same question, since later turns carry their own history.
+    Only complete 200 responses are shared, otherwise the waiting requests are sent on their own.
+    Streamed requests are always sent on their own: a waiting request would only get the copy
+    once the whole stream is read, which costs it its time to first token. Since the UI streams
+    its chat replies by default, in practice this coalesces the evaluator calls, the retries and
+    the chat calls of STREAM_RESPONSES=false, not the streamed chat traffic.
+    """
+    def __init__(self, name: str, api_key: str | None, base_url: str | None):
+        rate, burst = PROVIDER_LIMITS.get(name, (10.0, 20))
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.stats = {"requests": 0, "retries": 0, "throttled_seconds": 0.0, "coalesced": 0, "errors": 0}
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._async_flights = {}
+        self.client = OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0,
+            timeout=HTTP_TIMEOUT,
+            http_client=httpx.Client(transport=_ProviderTransport(self), timeout=HTTP_TIMEOUT),
+        )
+        self.async_client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0,
+            timeout=HTTP_TIMEOUT,
+            http_client=httpx.AsyncClient(transport=_AsyncProviderTransport(self), timeout=HTTP_TIMEOUT),
+        )
+
+    def _count(self, name: str, value: float = 1):
+        with self._lock:
+            self.stats[name] += value
+
+    @staticmethod
+    def flight_key(request: httpx.Request) -> tuple | None:
+        if request.method != "POST":
+            return None
+        body = request.read()
+        try:
+            streamed = json.loads(body).get("stream") is True
+        except (ValueError, AttributeError):
+            streamed = False
+        if streamed:
+            return None
+        return str(request.url), hashlib.sha256(body).hexdigest()
+
+    def _retry_or_return(self, attempt: int, response: httpx.Response | None, error: Exception | None) -> float | None:
+        """
+        Decides whether a failed attempt is retried.
+        :return: seconds to wait before the retry, or None to give up
+        """
+        if attempt >= MAX_RETRIES:
+            if error is not None or response.status_code in RETRY_STATUSES:
+                self._count("errors")
+            return None
+        if error is None and response.status_code not in RETRY_STATUSES:
+            return None
+        self._count("retries")
+        delay = backoff_delay(attempt, response)
+        logger.warning(
+            "%s request failed (%s), retrying in %.2fs",
+            self.name, error.__class__.__name__ if error is not None else response.status_code, delay,
+        )
+        return delay
+
+
+# class that sends the requests of a provider through its limits
+class _ProviderTransport(httpx.BaseTransport):
+    def __init__(self, provider: Provider):
+        self.provider = provider
+        self._transport = httpx.HTTPTransport(limits=HTTP_LIMITS)
+
+    def _send(self, request: httpx.Request) -> httpx.Response:
+        provider = self.provider
+        attempt = 0
+        while True:
+            provider._count("throttled_seconds", provider.bucket.acquire())
+            provider._count("requests")
+            response, error = None, None
+            try:
+                response = self._transport.handle_request(request)
+            except RETRY_ERRORS as exc:
+                error = exc
+            delay = provider._retry_or_return(attempt, response, error)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        provider = self.provider
+        key = provider.flight_key(request)
+        if key is None:
+            return self._send(request)
+        with provider._lock:
+            flight = provider._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = provider._flights[key] = _Flight(is_async=False)
+        if not leader:
+            if flight.event.wait(FLIGHT_WAIT) and flight.result is not None:
+                provider._count("coalesced")
+                telemetry.count("coalesced_requests", provider=provider.name)
+                return flight.response_for(request)
+            return self._send(request)
+
+        def finish(raw: bytes | None):
+            with provider._lock:
+                provider._flights.pop(key, None)
+            if raw is not None and response.status_code == 200:
+                flight.result = (response.status_code, response.headers, raw)
+            flight.event.set()
+
+        try:
+            response = self._send(request)
+        except BaseException:
+            finish(None)
+            raise
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=_TeeStream(response.stream, finish),
+            extensions=response.extensions,
+            request=request,
+        )
+
+    def close(self):
+        self._transport.close()
+
+
+# class that sends the requests of a provider through its limits, async version
+class _AsyncProviderTransport(httpx.AsyncBaseTransport):
+    def __init__(self, provider: Provider):
+        self.provider = provider
+        self._transport = httpx.AsyncHTTPTransport(limits=HTTP_LIMITS)
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        provider = self.provider
+        attempt = 0
+        while True:
+            provider._count("throttled_seconds", await provider.bucket.aacquire())
+            provider._count("requests")
+            response, error = None, None
+            try:
+                response = await self._transport.handle_async_request(request)
+            except RETRY_ERRORS as exc:
+                error = exc
+            delay = provider._retry_or_return(attempt, response, error)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+            if response is not None:
+                await response.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        provider = self.provider
+        key = provider.flight_key(request)
+        if key is None:
+            return await self._send(request)
+        # the async flights are only touched from the event loop
+        flight = provider._async_flights.get(key)
+        if flight is not None:
+            try:
+                await asyncio.wait_for(flight.event.wait(), FLIGHT_WAIT)
+            except asyncio.TimeoutError:
+                pass
+            if flight.result is not None:
+                provider._count("coalesced")
+                telemetry.count("coalesced_requests", provider=provider.name)
+                return flight.response_for(request)
+            return await self._send(request)
+
+        flight = provider._async_flights[key] = _Flight(is_async=True)
+
+        def finish(raw: bytes | None):
+            if provider._async_flights.get(key) is flight:
+                del provider._async_flights[key]
+            if raw is not None and response.status_code == 200:
+                flight.result = (response.status_code, response.headers, raw)
+            flight.event.set()
+
+        try:
+            response = await self._send(request)
+        except BaseException:
+            finish(None)
+            raise
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=_AsyncTeeStream(response.stream, finish),
+            extensions=response.extensions,
+            request=request,
+        )
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(name: str, api_key: str | None, base_url: str | None = None) -> Provider:
+    """
+    Returns the shared clients of a provider, created on first use.
+    :param name: "openai" or "gemini", it selects the rate limit
+    :param api_key: the API key
+    :param base_url: the OpenAI-compatible endpoint, None for OpenAI's
+    :return: the provider, with its client and async_client
+    """
+    key = (name, api_key, base_url)
+    with _providers_lock:
+        provider = _providers.get(key)
+        if provider is None:
+            provider = _providers[key] = Provider(name, api_key, base_url)
+            telemetry.register(f"http_{name}", provider.stats)
+        return provider
+
+
+def provider_stats() -> dict:
+    """
+    Counters of every provider created so far.
+    :return: dictionary of stats by provider name
+    """
+    with _providers_lock:
+        providers = list(_providers.values())
+    stats = {}
+    for provider in providers:
+        with provider._lock:
+            current = dict(provider.stats)
+        total = stats.setdefault(provider.name, dict.fromkeys(current, 0))
+        for key, value in current.items():
+            total[key] += value
+    return stats
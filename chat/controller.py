@@ -1,25 +1,229 @@
 from chat.chat import Chatbot
 from chat.rag import RAG
 from chat.evaluator import Evaluator
+from chat.grounding import GroundingEvaluator
+from chat.cache import SemanticCache
+from chat.personas import Persona, current_persona, persona_scope
+from chat.policy import EvaluationPolicy
+from chat.startup import profile
+from chat.telemetry import telemetry, request_id
+from chat.tools import lead_store
+from collections import deque
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# score replies against the retrieved chunks locally before calling the remote evaluator
+GROUNDING_PRECHECK = os.getenv("GROUNDING_PRECHECK", "true").lower() != "false"
+
+# words that make a question depend on what was said before
+CONTEXT_WORDS = re.compile(r"\b(it|its|that|this|those|these|them|they|there|then|above|previous|more|else|again|also)\b", re.IGNORECASE)
 
 class ChatController:
-    def __init__(self):
-        self.chatbot = Chatbot()
-        self.rag = RAG()
-        self.evaluator = Evaluator()
+    def __init__(self, persona: Persona | None = None, embedding=None, tool_executor=None, metrics_prefix: str = ""):
+        """
+        :param persona: who the agent speaks as and what it knows, the built-in persona by default
+        :param embedding: an embedding model shared with other personas, loaded here when None
+        :param tool_executor: a tool executor shared with other personas, a new one when None
+        :param metrics_prefix: prefix of the telemetry components, to tell the personas apart
+        """
+        self.persona = persona or Persona.default()
+        with profile.phase("create chatbot clients"):
+            self.chatbot = Chatbot(system_prompt=self.persona.system_prompt, tool_executor=tool_executor)
+        with profile.phase("rag"):
+            self.rag = RAG(
+                persist_dir=self.persona.persist_dir,
+                knowledge_dir=self.persona.knowledge_dir,
+                collection_name=self.persona.collection,
+                embedding=embedding,
+            )
+        if embedding is None:
+            with profile.phase("first query embedding"):
+                # the first call pays for lazy initialisation in torch, better here than in a request
+                self.rag.embed_query("warm-up")
+        with profile.phase("create evaluator clients"):
+            self.evaluator = Evaluator(name=self.persona.name)
+        if GROUNDING_PRECHECK:
+            # clearly grounded or ungrounded replies are decided locally, the rest go to the remote evaluator
+            self.evaluator = GroundingEvaluator(self.rag, self.evaluator)
+        self.cache = SemanticCache()
+        self.policy = EvaluationPolicy(
+            self.chatbot,
+            self.evaluator,
+            scorer=self.evaluator.score if GROUNDING_PRECHECK else None,
+            ascorer=self.evaluator.ascore if GROUNDING_PRECHECK else None,
+        )
+        # recent time-to-first-token and total latencies of streamed responses, in seconds
+        self.ttft_samples = deque(maxlen=1000)
+        self.total_samples = deque(maxlen=1000)
+        # the lead writer connects and warms the known emails in the background
+        self.leads = lead_store
+        self.leads.start()
+        # the counters the components keep are exported with the telemetry
+        self.components = {
+            f"{metrics_prefix}policy": self.policy.stats,
+            f"{metrics_prefix}cache": self.cache.stats,
+            "leads": self.leads.stats,
+            "tools": self.chatbot.tool_executor.stats,
+        }
+        if GROUNDING_PRECHECK:
+            self.components[f"{metrics_prefix}grounding"] = self.evaluator.stats
+        for component, stats in self.components.items():
+            telemetry.register(component, stats)
+        telemetry.start()
+
+    def close(self):
+        """
+        Stops exporting the counters of this persona and releases its embedding pool, when it
+        is dropped from a registry. The shared components keep theirs.
+        :return: None
+        """
+        for component in self.components:
+            if component not in ("leads", "tools"):
+                telemetry.unregister(component)
+        self.rag.close()
+
+    def _is_cacheable(self, msg: str, history: list) -> bool:
+        """
+        Decides whether the answer to a message can be shared between conversations.
+        That is the case for the first turn, and for later turns that do not refer back
+        to the conversation.
+        :param msg: the message from the user
+        :param history: the history of the conversation, it may already end with msg
+        :return: True if the reply can be cached
+        """
+        if "@" in msg:
+            # messages carrying an email address are personal
+            return False
+        previous = history[:-1] if history and history[-1].get("content") == msg else history
+        if not previous:
+            return True
+        return not CONTEXT_WORDS.search(msg)
 
     def get_response(self, msg: str, history: list, emails_sent: list) -> tuple[str, list]:
+        with telemetry.request(), persona_scope(self.persona.id):
+            return self._get_response(msg, history, emails_sent)
+
+    def _get_response(self, msg: str, history: list, emails_sent: list) -> tuple[str, list]:
+        start = time.perf_counter()
+        # the query embedding is shared by the answer cache and the retrieval
+        query_embedding = self.rag.embed_query(msg)
+        # an offline re-ingestion changes the version, which drops the cached answers
+        version = self.rag.refresh()
+        cacheable = self._is_cacheable(msg, history)
+        if cacheable:
+            self.cache.validate(version)
+            cached_reply = self.cache.get(query_embedding)
+            if cached_reply is not None:
+                return cached_reply, emails_sent
+
         # get relevant chunks from our knwoledge base
-        relevant_chunks = self.rag.get_relevant_chunks(msg)
+        relevant_chunks = self.rag.get_relevant_chunks(msg, embedding=query_embedding)
         # get response from the chatbot
-        reply, emails = self.chatbot.chat(msg, history, emails_sent, relevant_chunks)
-        # evaluate response
-        evaluation = self.evaluator.evaluate(reply, msg, history)
+        turn = {}
+        reply, emails = self.chatbot.chat(msg, history, emails_sent, relevant_chunks, turn=turn)
+
+        # evaluate the response and retry it within the latency budget
+        with telemetry.span("evaluation"):
+            reply, approved = self.policy.run(reply, msg, history, start, tool_turn=turn["tool_only"], relevant_chunks=relevant_chunks)
+
+        # only approved replies are shared, replies of turns that ran a tool belong to this user only
+        if cacheable and approved and not turn["tool_calls"]:
+            self.cache.put(query_embedding, reply)
+
+        return reply, emails
+
+    async def aget_response(self, msg: str, history: list, emails_sent: list) -> tuple[str, list]:
+        """
+        Async version of get_response. Model calls are awaited and the embedding runs on
+        the RAG pool, so concurrent sessions overlap instead of queueing on worker threads.
+        """
+        with telemetry.request(), persona_scope(self.persona.id):
+            return await self._aget_response(msg, history, emails_sent)
+
+    async def _aget_response(self, msg: str, history: list, emails_sent: list) -> tuple[str, list]:
+        start = time.perf_counter()
+        query_embedding = await self.rag.aembed_query(msg)
+        version = await self.rag.arefresh()
+        cacheable = self._is_cacheable(msg, history)
+        if cacheable:
+            self.cache.validate(version)
+            cached_reply = self.cache.get(query_embedding)
+            if cached_reply is not None:
+                return cached_reply, emails_sent
+
+        relevant_chunks = await self.rag.aget_relevant_chunks(msg, embedding=query_embedding)
+        turn = {}
+        reply, emails = await self.chatbot.achat(msg, history, emails_sent, relevant_chunks, turn=turn)
+
+        with telemetry.span("evaluation"):
+            reply, approved = await self.policy.arun(reply, msg, history, start, tool_turn=turn["tool_only"], relevant_chunks=relevant_chunks)
+
+        if cacheable and approved and not turn["tool_calls"]:
+            self.cache.put(query_embedding, reply)
+
+        return reply, emails
+
+    async def astream_response(self, msg: str, history: list, emails_sent: list):
+        """
+        Streams the response, yielding the reply so far and the recorded emails.
+        The tokens are shown as they arrive, the evaluation runs on the finished text and
+        when it rejects the reply the last yielded value replaces it with the retry.
+        """
+        with telemetry.request("request.stream") as correlation_id, persona_scope(self.persona.id):
+            async for item in self._astream_response(msg, history, emails_sent):
+                yield item
+                # the consumer may resume the generator from another task, whose context lacks the id
+                if correlation_id is not None:
+                    request_id.set(correlation_id)
+                current_persona.set(self.persona.id)
+
+    async def _astream_response(self, msg: str, history: list, emails_sent: list):
+        start = time.perf_counter()
+        first_token = None
+
+        query_embedding = await self.rag.aembed_query(msg)
+        version = await self.rag.arefresh()
+        cacheable = self._is_cacheable(msg, history)
+        if cacheable:
+            self.cache.validate(version)
+            cached_reply = self.cache.get(query_embedding)
+            if cached_reply is not None:
+                self._record_latency(start, time.perf_counter())
+                yield cached_reply, emails_sent
+                return
+
+        relevant_chunks = await self.rag.aget_relevant_chunks(msg, embedding=query_embedding)
+        turn = {}
+        reply = ""
+        async for delta in self.chatbot.astream_chat(msg, history, emails_sent, relevant_chunks, turn=turn):
+            if first_token is None:
+                first_token = time.perf_counter()
+            reply += delta
+            yield reply, emails_sent
+
+        with telemetry.span("evaluation"):
+            final_reply, approved = await self.policy.arun(reply, msg, history, start, tool_turn=turn["tool_only"], relevant_chunks=relevant_chunks)
+        if final_reply != reply:
+            yield final_reply, emails_sent
 
-        # if the response is not good, get a new response
-        # evaluate response until we get a good one
-        while not evaluation.is_good_response:
-            reply = self.chatbot.retry(reply, msg, history, evaluation.feedback)
-            evaluation = self.evaluator.evaluate(reply, msg, history)
+        if cacheable and approved and not turn["tool_calls"]:
+            self.cache.put(query_embedding, final_reply)
+        self._record_latency(start, first_token or time.perf_counter())
 
-        return reply, emails
\ No newline at end of file
+    def _record_latency(self, start: float, first_token: float):
+        """
+        Records the time to first token, the headline latency of the streaming mode, and the total time.
+        :param start: when the request started
+        :param first_token: when the first token was shown
+        :return: None
+        """
+        ttft = first_token - start
+        total = time.perf_counter() - start
+        self.ttft_samples.append(ttft)
+        self.total_samples.append(total)
+        telemetry.observe("time_to_first_token_seconds", ttft)
+        logger.info("time to first token %.3fs, total %.3fs", ttft, total)
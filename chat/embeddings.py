@@ -0,0 +1,246 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import inspect
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# embedding backends that RAG can use
+EMBEDDING_BACKENDS = ("huggingface", "onnx")
+
+
+def load_embeddings(model_name: str, backend: str = "huggingface") -> Embeddings:
+    """
+    Loads the embedding model with the selected backend.
+    :param model_name: the sentence-transformers model
+    :param backend: "huggingface" for the PyTorch model, "onnx" for the int8 ONNX export of it
+    :return: the embeddings, usable by the vector stores
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}', expected one of {EMBEDDING_BACKENDS}")
+    if backend == "onnx":
+        return OnnxEmbeddings(model_name)
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=model_name)
+
+
+def export_onnx(model_name: str, export_dir: str, max_length: int) -> str:
+    """
+    Exports a sentence-transformers model to ONNX and quantizes its weights to int8.
+    Needs torch and transformers (installed with sentence-transformers) and onnx; it runs
+    once, the runtime only needs onnxruntime and tokenizers.
+    :param model_name: the model to export
+    :param export_dir: folder for the model, its tokenizer and export.json
+    :param max_length: maximum number of tokens of an input
+    :return: the path of the quantized model
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(export_dir, exist_ok=True)
+    fp32_path = os.path.join(export_dir, "model.onnx")
+    int8_path = os.path.join(export_dir, "model_int8.onnx")
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    sample = tokenizer(["warm-up"], return_tensors="pt")
+    # the order of forward() for BERT-like models
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    axes = {0: "batch", 1: "sequence"}
+    options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        options["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[name] for name in input_names),
+            fp32_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={**{name: axes for name in input_names}, "last_hidden_state": axes},
+            opset_version=14,
+            **options,
+        )
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    os.remove(fp32_path)
+    tokenizer.save_pretrained(export_dir)
+    with open(os.path.join(export_dir, "export.json"), "w", encoding="utf-8") as f:
+        json.dump({"model_name": model_name, "max_length": max_length, "quantization": "dynamic int8"}, f, indent=2)
+    return int8_path
+
+
+# class that gathers concurrent queries into one forward pass
+class _MicroBatcher:
+    """
+    A single worker takes the queued queries in batches: whatever is queued when it becomes
+    free, plus what arrives within the window. With a window of 0 a lone query is not delayed,
+    and under load the queries that arrive during a forward pass share the next one.
+    """
+    def __init__(self, encode, max_batch: int, window: float, count):
+        """
+        :param count: function (name, value) that adds to the counters of the owner
+        """
+        self.encode = encode
+        self.max_batch = max_batch
+        self.window = window
+        self.count = count
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self._queue.put((text, future))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                    self._thread.start()
+        return future
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = dict(zip(texts, self.encode(texts)))
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            self.count("batches")
+            self.count("batched_queries", len(batch))
+            for text, future in batch:
+                future.set_result(vectors[text])
+
+
+# class that embeds text with the int8 ONNX export of a sentence-transformers model
+class OnnxEmbeddings(Embeddings):
+    """
+    CPU-optimized drop-in for HuggingFaceEmbeddings.
+    The model is exported to ONNX with int8 dynamic quantization on first use and kept under
+    EMBEDDING_ONNX_DIR; later loads only need onnxruntime and tokenizers, so PyTorch is never
+    imported. Vectors are mean-pooled and normalized like the sentence-transformers pipeline.
+    Concurrent queries are micro-batched into one forward pass, and the vectors of recent
+    queries are kept in an LRU cache. Documents are embedded in length-sorted batches so the
+    padding stays small.
+    """
+    EXPORT_DIR = os.getenv("EMBEDDING_ONNX_DIR", "onnx_models")
+    THREADS = int(os.getenv("EMBEDDING_THREADS", str(min(4, os.cpu_count() or 1))))
+    MAX_LENGTH = int(os.getenv("EMBEDDING_MAX_LENGTH", "256"))
+    QUERY_CACHE_SIZE = int(os.getenv("EMBEDDING_QUERY_CACHE", "1024"))
+    MAX_BATCH = int(os.getenv("EMBEDDING_MAX_BATCH", "32"))
+    BATCH_WINDOW = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "0")) / 1000
+
+    def __init__(self, model_name: str, export_dir: str | None = None, threads: int = THREADS):
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as error:
+            raise ImportError("The onnx embedding backend needs onnxruntime: pip install onnxruntime onnx") from error
+
+        self.model_name = model_name
+        self.export_dir = export_dir or os.path.join(self.EXPORT_DIR, model_name.replace("/", "__"))
+        model_path = os.path.join(self.export_dir, "model_int8.onnx")
+        if not os.path.exists(model_path):
+            logger.info("exporting %s to ONNX int8 in %s", model_name, self.export_dir)
+            model_path = export_onnx(model_name, self.export_dir, self.MAX_LENGTH)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(self.export_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.MAX_LENGTH)
+        pad_token = "[PAD]"
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad_token) or 0, pad_token=pad_token)
+
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {"queries": 0, "cache_hits": 0, "documents": 0, "batches": 0, "batched_queries": 0}
+        self._batcher = _MicroBatcher(self._encode, self.MAX_BATCH, self.BATCH_WINDOW, self._count)
+
+    def _count(self, name: str, value: int = 1):
+        with self._stats_lock:
+            self.stats[name] += value
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Runs one forward pass.
+        :param texts: the texts of the batch
+        :return: normalized float32 vectors, one row per text
+        """
+        encodings = self.tokenizer.encode_batch(texts)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": attention_mask,
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds documents in batches of similar length.
+        :param texts: the documents
+        :return: the embeddings, in the order of the texts
+        """
+        texts = list(texts)
+        self._count("documents", len(texts))
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.MAX_BATCH):
+            indexes = order[start:start + self.MAX_BATCH]
+            for i, vector in zip(indexes, self._encode([texts[i] for i in indexes])):
+                vectors[i] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Embeds a query, from the LRU cache when it was asked recently.
+        :param text: the query
+        :return: the embedding of the query
+        """
+        self._count("queries")
+        with self._cache_lock:
+            vector = self._cache.get(text)
+            if vector is not None:
+                self._cache.move_to_end(text)
+                self._count("cache_hits")
+                return list(vector)
+        vector = self._batcher.submit(text).result().tolist()
+        if self.QUERY_CACHE_SIZE:
+            with self._cache_lock:
+                self._cache[text] = vector
+                while len(self._cache) > self.QUERY_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return list(vector)
@@ -1,7 +1,9 @@
 from dotenv import load_dotenv
-from openai import OpenAI
 import os
 from pydantic import BaseModel
+from chat.clients import get_provider
+from chat.prompt import PromptBuilder
+from chat.telemetry import telemetry
 
 load_dotenv(override=True)
 
@@ -15,10 +17,19 @@ class Evaluator:
     MODEL = "gemini-2.0-flash"
     NAME = "Diego"
     GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+    # OpenAI-compatible endpoint of gemini, it can point to a local server for the benchmarks
+    BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta/openai/")
     
-    def __init__(self):
+    def __init__(self, name: str = NAME):
+        """
+        :param name: the name of the persona the agent speaks as
+        """
+        self.name = name
         # init of the gemini client since we are using the gemini api for the evaluator
-        self.client = OpenAI(api_key=self.GOOGLE_API_KEY, base_url="https://generativelanguage.googleapis.com/v1beta/openai/")
+        provider = get_provider("gemini", self.GOOGLE_API_KEY, self.BASE_URL)
+        self.client = provider.client
+        self.prompt_builder = PromptBuilder(model=self.MODEL)
+        self.async_client = provider.async_client
 
     def _get_evaluation_system_prompt(self):
         """
@@ -32,9 +43,9 @@ class Evaluator:
         """
         return f"You are an evaluator that decides whether a response to a question is acceptable. \
             You are provided with a conversation between a User and an Agent. Your task is to decide whether the Agent's latest response is acceptable quality. \
-            The Agent is playing the role of {self.NAME} and is representing {self.NAME} on their website. \
+            The Agent is playing the role of {self.name} and is representing {self.name} on their website. \
             The Agent has been instructed to be professional and engaging, as if talking to a potential client or future employer who came across the website. \
-            The Agent has been provided with context on {self.NAME} in the form of their summary, experience and CV. \
+            The Agent has been provided with context on {self.name} in the form of their summary, experience and CV. \
             With this context, please evaluate the latest response, replying with whether the response is a good response and your feedback. "
     def _get_evaluation_user_prompt(self, reply: str, msg: str, history: list) -> str:
         """
@@ -46,35 +57,70 @@ class Evaluator:
         The user prompt is also used to evaluate the evaluator's responses.
         :return: the user prompt
         """
+        # only a trimmed window of the conversation is sent to the evaluator
+        conversation = self.prompt_builder.render_history(history, msg)
         user_prompt = f"""
         The Agent's latest response was: {reply}
         The User's latest message was: {msg}
-        The conversation history was: {history}
+        The conversation history was:
+        {conversation}
         Please evaluate the response and provide feedback or say it is acceptable.
         """
         return user_prompt
 
 
-    def evaluate(self, reply: str, msg: str, history: list) -> Evaluation:
+    def _get_evaluation_messages(self, reply: str, msg: str, history: list) -> list:
         """
-        Evaluates the response of the chatbot.
+        Builds the messages sent to the evaluator model.
         :param reply: the response of the chatbot
         :param msg: the message from the user
         :param history: the history of the conversation
-        :return: the evaluation of the response
+        :return: list of messages
         """
         system_prompt = self._get_evaluation_system_prompt()
         user_prompt = self._get_evaluation_user_prompt(reply, msg, history)
 
-        messages = [
+        return [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
         ]
+
+    def evaluate(self, reply: str, msg: str, history: list) -> Evaluation:
+        """
+        Evaluates the response of the chatbot.
+        :param reply: the response of the chatbot
+        :param msg: the message from the user
+        :param history: the history of the conversation
+        :return: the evaluation of the response
+        """
+        messages = self._get_evaluation_messages(reply, msg, history)
         
-        response = self.client.beta.chat.completions.parse(
-            model=self.MODEL,
-            messages=messages,
-            response_format=Evaluation,
-        )
+        with telemetry.span("llm.evaluate", model=self.MODEL) as span:
+            response = self.client.beta.chat.completions.parse(
+                model=self.MODEL,
+                messages=messages,
+                response_format=Evaluation,
+            )
+            telemetry.record_usage(self.MODEL, response.usage, span)
 
         return response.choices[0].message.parsed        
+
+    async def aevaluate(self, reply: str, msg: str, history: list) -> Evaluation:
+        """
+        Async version of evaluate.
+        :param reply: the response of the chatbot
+        :param msg: the message from the user
+        :param history: the history of the conversation
+        :return: the evaluation of the response
+        """
+        messages = self._get_evaluation_messages(reply, msg, history)
+
+        with telemetry.span("llm.evaluate", model=self.MODEL) as span:
+            response = await self.async_client.beta.chat.completions.parse(
+                model=self.MODEL,
+                messages=messages,
+                response_format=Evaluation,
+            )
+            telemetry.record_usage(self.MODEL, response.usage, span)
+
+        return response.choices[0].message.parsed
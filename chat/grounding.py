@@ -0,0 +1,191 @@
+from chat.evaluator import Evaluation, Evaluator
+from chat.telemetry import telemetry
+from collections import OrderedDict
+import os
+import re
+import threading
+
+import numpy as np
+
+# splits a reply into sentences and list items
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+|\n+")
+# markdown decoration that does not carry meaning
+MARKDOWN = re.compile(r"^[\s#>*\-•\d.)]+|[*_`]+")
+# sentences that are about the conversation itself and have nothing to ground
+CONVERSATIONAL = re.compile(
+    r"(don't|do not) (have enough|know)|email|contact|reach out|feel free|let me know|happy to|glad to|thank",
+    re.IGNORECASE,
+)
+
+# class that checks locally whether a reply is supported by the retrieved chunks
+class GroundingEvaluator:
+    """
+    First-stage evaluator that scores how well each sentence of the reply is supported by
+    the chunks retrieved for the message, using the embedding model already loaded by RAG.
+    Clearly grounded replies pass, clearly ungrounded ones are rejected with feedback listing
+    the unsupported sentences, and only the uncertain ones are sent to the remote evaluator.
+    """
+    PASS_THRESHOLD = float(os.getenv("GROUNDING_PASS", "0.8"))
+    FAIL_THRESHOLD = float(os.getenv("GROUNDING_FAIL", "0.3"))
+    SENTENCE_THRESHOLD = float(os.getenv("GROUNDING_SENTENCE_SIMILARITY", "0.55"))
+    MIN_WORDS = 4
+    CHUNK_CACHE_SIZE = 512
+
+    def __init__(
+        self,
+        rag,
+        evaluator: Evaluator,
+        pass_threshold: float = PASS_THRESHOLD,
+        fail_threshold: float = FAIL_THRESHOLD,
+        sentence_threshold: float = SENTENCE_THRESHOLD,
+    ):
+        """
+        :param rag: the RAG whose embedding model and recent retrievals are reused
+        :param evaluator: the remote evaluator for the uncertain cases
+        :param pass_threshold: fraction of supported sentences above which the reply passes
+        :param fail_threshold: fraction of supported sentences below which the reply is rejected
+        :param sentence_threshold: cosine similarity a sentence needs with some chunk to be supported
+        """
+        self.rag = rag
+        self.evaluator = evaluator
+        self.pass_threshold = pass_threshold
+        self.fail_threshold = fail_threshold
+        self.sentence_threshold = sentence_threshold
+        self._chunk_vectors = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"local_pass": 0, "local_fail": 0, "remote": 0}
+
+    @property
+    def remote_calls_saved(self) -> int:
+        return self.stats["local_pass"] + self.stats["local_fail"]
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _sentences(self, reply: str) -> list[str]:
+        """
+        Splits the reply into the sentences that make factual claims.
+        :param reply: the reply
+        :return: list of sentences
+        """
+        sentences = []
+        for sentence in SENTENCE_SPLIT.split(reply or ""):
+            sentence = MARKDOWN.sub("", sentence).strip()
+            if len(sentence.split()) < self.MIN_WORDS or CONVERSATIONAL.search(sentence):
+                continue
+            sentences.append(sentence)
+        return sentences
+
+    def _embed(self, texts: list[str]) -> np.ndarray:
+        vectors = np.asarray(self.rag.embedding.embed_documents(texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _chunk_matrix(self, chunks: list[str]) -> np.ndarray:
+        """
+        Returns the normalized embeddings of the chunks, embedding only the ones not seen recently.
+        :param chunks: the retrieved chunks
+        :return: matrix with one row per chunk
+        """
+        with self._lock:
+            missing = [chunk for chunk in dict.fromkeys(chunks) if chunk not in self._chunk_vectors]
+        if missing:
+            vectors = self._embed(missing)
+            with self._lock:
+                for chunk, vector in zip(missing, vectors):
+                    self._chunk_vectors[chunk] = vector
+                while len(self._chunk_vectors) > self.CHUNK_CACHE_SIZE:
+                    self._chunk_vectors.popitem(last=False)
+        with self._lock:
+            rows = [self._chunk_vectors.get(chunk) for chunk in chunks]
+        evicted = [i for i, vector in enumerate(rows) if vector is None]
+        if evicted:
+            # evicted by a concurrent request in the meantime, embedded outside the lock
+            for i, vector in zip(evicted, self._embed([chunks[i] for i in evicted])):
+                rows[i] = vector
+        return np.stack(rows)
+
+    def support(self, reply: str, msg: str) -> tuple[float | None, list[str]]:
+        """
+        Scores the reply against the chunks retrieved for the message.
+        :param reply: the reply
+        :param msg: the message from the user
+        :return: the fraction of supported sentences (None when there is nothing to score)
+                 and the sentences that are not supported
+        """
+        sentences = self._sentences(reply)
+        chunks = self.rag.get_relevant_chunks(msg)
+        if not sentences or not chunks:
+            return None, []
+        similarities = self._embed(sentences) @ self._chunk_matrix(chunks).T
+        best = similarities.max(axis=1)
+        unsupported = [sentence for sentence, score in zip(sentences, best) if score < self.sentence_threshold]
+        return 1.0 - len(unsupported) / len(sentences), unsupported
+
+    def score(self, reply: str, msg: str) -> float:
+        """
+        Grounding score used to rank candidate replies.
+        :param reply: the reply
+        :param msg: the message from the user
+        :return: the fraction of supported sentences, 0.5 when there is nothing to score
+        """
+        grounded, _ = self.support(reply, msg)
+        return 0.5 if grounded is None else grounded
+
+    async def ascore(self, reply: str, msg: str) -> float:
+        """
+        Async version of score, the embedding runs on the RAG embedding pool.
+        """
+        return await self.rag.run_in_executor(self.score, reply, msg)
+
+    def _local_verdict(self, reply: str, msg: str) -> Evaluation | None:
+        """
+        Decides locally when the reply is clearly grounded or clearly not.
+        :return: the evaluation, or None when the remote evaluator must decide
+        """
+        with telemetry.span("evaluate.local") as span:
+            grounded, unsupported = self.support(reply, msg)
+            span.set(grounded=grounded)
+        if grounded is None:
+            return None
+        if grounded >= self.pass_threshold:
+            self._count("local_pass")
+            return Evaluation(is_good_response=True, feedback="The reply is supported by the knowledge base.")
+        if grounded <= self.fail_threshold:
+            self._count("local_fail")
+            listed = "\n".join(f"- {sentence}" for sentence in unsupported[:5])
+            return Evaluation(
+                is_good_response=False,
+                feedback=(
+                    "These statements are not supported by the provided context:\n"
+                    f"{listed}\n"
+                    "Only state facts that appear in the context, or say you don't have enough information."
+                ),
+            )
+        return None
+
+    def evaluate(self, reply: str, msg: str, history: list) -> Evaluation:
+        """
+        Evaluates the response of the chatbot, locally when possible.
+        :param reply: the response of the chatbot
+        :param msg: the message from the user
+        :param history: the history of the conversation
+        :return: the evaluation of the response
+        """
+        evaluation = self._local_verdict(reply, msg)
+        if evaluation is not None:
+            return evaluation
+        self._count("remote")
+        return self.evaluator.evaluate(reply, msg, history)
+
+    async def aevaluate(self, reply: str, msg: str, history: list) -> Evaluation:
+        """
+        Async version of evaluate, the local scoring runs on the RAG embedding pool.
+        """
+        evaluation = await self.rag.run_in_executor(self._local_verdict, reply, msg)
+        if evaluation is not None:
+            return evaluation
+        self._count("remote")
+        return await self.evaluator.aevaluate(reply, msg, history)
@@ -0,0 +1,268 @@
+import argparse
+import os
+from typing import Iterator
+
+from chat.manifest import IngestManifest, hash_bytes, chunk_id
+
+# splitters that can be selected for the ingestion
+SPLITTERS = ("sentence", "token")
+
+# default chunk size and overlap for each splitter, sentence is measured in characters and token in tokens
+SPLITTER_DEFAULTS = {
+    "sentence": {"chunk_size": 800, "chunk_overlap": 100},
+    "token": {"chunk_size": 200, "chunk_overlap": 40},
+}
+
+
+def _ensure_nltk_data():
+    """
+    Downloads the sentence tokenizer the first time it is needed.
+    :return: None
+    """
+    import nltk
+
+    for resource in ("punkt", "punkt_tab"):
+        try:
+            nltk.data.find(f"tokenizers/{resource}")
+        except LookupError:
+            nltk.download(resource, quiet=True)
+
+
+def splitter_config(splitter: str = "sentence", chunk_size: int | None = None, chunk_overlap: int | None = None) -> dict:
+    """
+    Resolves the splitter settings, filling in the defaults of the chosen splitter.
+    :param splitter: "sentence" splits on sentence boundaries with NLTK, "token" uses a sliding token window
+    :param chunk_size: the size of a chunk
+    :param chunk_overlap: the overlap between consecutive chunks
+    :return: the splitter settings, they are stored in the manifest
+    """
+    if splitter not in SPLITTERS:
+        raise ValueError(f"Unknown splitter '{splitter}', expected one of {SPLITTERS}")
+    defaults = SPLITTER_DEFAULTS[splitter]
+    return {
+        "splitter": splitter,
+        "chunk_size": chunk_size or defaults["chunk_size"],
+        "chunk_overlap": defaults["chunk_overlap"] if chunk_overlap is None else chunk_overlap,
+    }
+
+
+def build_splitter(config: dict):
+    """
+    Builds the text splitter used to chunk the knowledge base.
+    :param config: the settings returned by splitter_config
+    :return: the splitter
+    """
+    # imported here, a sync where no file changed never needs them
+    from langchain.text_splitter import NLTKTextSplitter, TokenTextSplitter
+
+    if config["splitter"] == "sentence":
+        _ensure_nltk_data()
+        return NLTKTextSplitter(chunk_size=config["chunk_size"], chunk_overlap=config["chunk_overlap"])
+    return TokenTextSplitter(
+        encoding_name="cl100k_base", chunk_size=config["chunk_size"], chunk_overlap=config["chunk_overlap"]
+    )
+
+
+def iter_knowledge_files(knowledge_dir: str) -> Iterator[str]:
+    """
+    Walks the knowledge directory in a stable order, skipping hidden files and folders.
+    :param knowledge_dir: the root of the knowledge base
+    :return: iterator of file paths
+    """
+    for root, dirs, files in os.walk(knowledge_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if not name.startswith("."):
+                yield os.path.join(root, name)
+
+
+# class that streams the knowledge base into the vector store
+class IngestionPipeline:
+    """
+    Streams every file under the knowledge directory through a splitter and embeds the
+    chunks in fixed-size batches, so memory stays bounded by one file plus one batch.
+    The manifest makes it incremental: unchanged files are skipped after hashing them,
+    only new chunks are embedded and chunks of changed or removed files are deleted.
+    """
+
+    def __init__(
+        self,
+        vstore,
+        manifest: IngestManifest,
+        knowledge_dir: str = "knowledge",
+        splitter: str = "sentence",
+        chunk_size: int | None = None,
+        chunk_overlap: int | None = None,
+        batch_size: int = 64,
+        commit=None,
+        model_name: str | None = None,
+        embedding_backend: str | None = None,
+    ):
+        """
+        :param model_name: the embedding model, stored in the manifest so a new model re-embeds everything
+        :param embedding_backend: the backend that runs the model, stored for the same reason
+        :param commit: optional callable that makes the store changes durable, it gets the counters
+                       and runs before the manifest is saved so the manifest never describes
+                       chunks the store lost
+        """
+        self.vstore = vstore
+        self.commit = commit
+        self.manifest = manifest
+        self.knowledge_dir = knowledge_dir
+        self.batch_size = batch_size
+        self.config = splitter_config(splitter, chunk_size, chunk_overlap)
+        # the vectors of another model, or of the same model run by another backend, do not mix
+        self.config.update({"model_name": model_name, "embedding_backend": embedding_backend})
+        self._splitter = None
+        self._batch = []
+        self.stats = {"files": 0, "files_changed": 0, "files_removed": 0, "chunks_added": 0, "chunks_deleted": 0}
+
+    @property
+    def splitter(self):
+        """
+        The text splitter, built when the first changed file has to be split.
+        """
+        if self._splitter is None:
+            self._splitter = build_splitter(self.config)
+        return self._splitter
+
+    def run(self) -> dict:
+        """
+        Brings the vector store in sync with the knowledge directory.
+        :return: counters describing what was done
+        """
+        if self.manifest.config and self.manifest.config != self.config:
+            # the chunking or the embedding model changed, every file has to be split and embedded again
+            for source in list(self.manifest.sources):
+                self._delete(self.manifest.remove(source))
+        self.manifest.config = self.config
+
+        seen = set()
+        for source in iter_knowledge_files(self.knowledge_dir):
+            seen.add(source)
+            self.stats["files"] += 1
+            self._ingest_file(source)
+        self._flush()
+
+        # sources that were ingested before but no longer exist
+        for source in set(self.manifest.sources).difference(seen):
+            self._delete(self.manifest.remove(source))
+            self.stats["files_removed"] += 1
+
+        if self.commit is not None:
+            self.commit(self.stats)
+        if self.stats["files_changed"] or self.stats["files_removed"] or self.stats["chunks_deleted"] or not self.manifest.exists:
+            self.manifest.save()
+        return self.stats
+
+    def _ingest_file(self, source: str):
+        """
+        Splits a file and queues the chunks that are not in the store yet.
+        :param source: the path of the file
+        :return: None
+        """
+        with open(source, "rb") as f:
+            raw = f.read()
+        file_hash = hash_bytes(raw)
+        if file_hash == self.manifest.file_hash(source):
+            return
+
+        old_ids = set(self.manifest.chunk_ids(source))
+        ids = {}
+        for text in self.splitter.split_text(raw.decode("utf-8", errors="replace")):
+            id_ = chunk_id(source, text)
+            if id_ in ids:
+                continue
+            ids[id_] = None
+            if id_ not in old_ids:
+                self._queue(id_, text, {"source": source, "chunk_id": id_})
+
+        self._delete(list(old_ids.difference(ids)))
+        self.manifest.update(source, file_hash, list(ids))
+        self.stats["files_changed"] += 1
+
+    def _queue(self, id_: str, text: str, metadata: dict):
+        """
+        Adds a chunk to the current batch and embeds the batch once it is full.
+        :return: None
+        """
+        self._batch.append((id_, text, metadata))
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        """
+        Embeds and stores the current batch.
+        :return: None
+        """
+        if not self._batch:
+            return
+        ids, texts, metadatas = zip(*self._batch)
+        self.vstore.add_texts(texts=list(texts), metadatas=list(metadatas), ids=list(ids))
+        self.stats["chunks_added"] += len(ids)
+        self._batch = []
+
+    def _delete(self, ids: list[str]):
+        """
+        Deletes chunks from the store.
+        :return: None
+        """
+        if ids:
+            self.vstore.delete(ids=ids)
+            self.stats["chunks_deleted"] += len(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the knowledge base vector store offline.")
+    parser.add_argument("--knowledge-dir", default="knowledge")
+    parser.add_argument("--persist-dir", default="chroma_store")
+    parser.add_argument("--model-name", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--splitter", choices=SPLITTERS, default="sentence")
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--chunk-overlap", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--backend", choices=("chroma", "numpy"), default="chroma")
+    parser.add_argument("--quantize", action="store_true", help="store int8 vectors in the numpy index")
+    # the same default as the app, a store ingested with another model is re-embedded on its next sync
+    parser.add_argument("--embedding-backend", choices=("huggingface", "onnx"), default=os.getenv("EMBEDDING_BACKEND", "huggingface"),
+                        help="onnx embeds with the int8 ONNX export of the model")
+    parser.add_argument("--rebuild", action="store_true", help="drop the manifest and embed everything again")
+    parser.add_argument("--persona", default=None,
+                        help="ingest the knowledge and collection of this persona of PERSONAS_DIR")
+    args = parser.parse_args()
+
+    from chat.rag import RAG
+
+    knowledge_dir, collection_name = args.knowledge_dir, RAG.DEFAULT_COLLECTION
+    if args.persona:
+        from chat.personas import Persona, PersonaRegistry
+
+        personas = Persona.discover(PersonaRegistry.PERSONAS_DIR)
+        if args.persona not in personas:
+            parser.error(f"unknown persona '{args.persona}', expected one of {sorted(personas)}")
+        knowledge_dir, collection_name = personas[args.persona].knowledge_dir, personas[args.persona].collection
+
+    rag = RAG(
+        persist_dir=args.persist_dir,
+        model_name=args.model_name,
+        knowledge_dir=knowledge_dir,
+        collection_name=collection_name,
+        splitter=args.splitter,
+        chunk_size=args.chunk_size,
+        chunk_overlap=args.chunk_overlap,
+        sync_on_startup=False,
+        backend=args.backend,
+        quantize=args.quantize,
+        embedding_backend=args.embedding_backend,
+    )
+    if args.rebuild:
+        rag.manifest.reset()
+    stats = rag.sync(batch_size=args.batch_size)
+    print(
+        f"{stats['files']} files, {stats['files_changed']} changed, {stats['files_removed']} removed, "
+        f"{stats['chunks_added']} chunks embedded, {stats['chunks_deleted']} chunks deleted"
+    )
+
+
+if __name__ == "__main__":
+    main()
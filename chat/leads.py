@@ -0,0 +1,310 @@
+from dotenv import load_dotenv
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+load_dotenv(override=True)
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_email(email: str) -> str:
+    """
+    Normalizes an email address so the same address is always the same key.
+    :param email: the email address
+    :return: the trimmed, lowercase address
+    """
+    return (email or "").strip().lower()
+
+
+# class that implements the lead store with write-behind batching
+class LeadStore:
+    """
+    Records the leads captured by the record_user_details tool without putting Mongo on the request path.
+    The emails already stored are kept in an in-process set, warmed from the collection when the
+    writer starts, so duplicate checks never need a round-trip. New leads go onto a bounded queue
+    that a background writer drains with batched insert_many calls; the collection has a unique index on
+    email, so a lead that is written twice is still stored once. A collection that already holds
+    duplicates cannot get the index, and then only the in-process set prevents new ones. When Mongo
+    cannot be reached the batch is appended to a JSON lines spill file and replayed on the next
+    successful flush.
+
+    The Mongo connection is opened lazily by the writer thread. Pass a collection (for instance a
+    mongomock collection) to run against a local stand-in instead of MONGO_URI.
+    """
+    QUEUE_SIZE = int(os.getenv("LEADS_QUEUE_SIZE", "1000"))
+    BATCH_SIZE = int(os.getenv("LEADS_BATCH_SIZE", "100"))
+    FLUSH_INTERVAL = float(os.getenv("LEADS_FLUSH_INTERVAL", "2"))
+    SPILL_PATH = os.getenv("LEADS_SPILL_PATH", "leads_spill.jsonl")
+
+    def __init__(
+        self,
+        collection=None,
+        spill_path: str = SPILL_PATH,
+        queue_size: int = QUEUE_SIZE,
+        batch_size: int = BATCH_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+    ):
+        self._collection = collection
+        self.spill_path = spill_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.known = set()
+        self.warmed = False
+        # the unique index still has to be created, it is retried while Mongo was unreachable
+        self._index_pending = True
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._writer = None
+        self._stopping = threading.Event()
+        self.stats = {"recorded": 0, "duplicates": 0, "written": 0, "batches": 0, "spilled": 0, "replayed": 0}
+
+    @property
+    def collection(self):
+        """
+        The Mongo collection, connected on first use.
+        """
+        if self._collection is None:
+            from pymongo import MongoClient
+            import certifi
+
+            client = MongoClient(os.getenv("MONGO_URI"), tls=True, tlsCAFile=certifi.where())
+            self._collection = client[os.getenv("MONGO_DB_CLIENT")][os.getenv("MONGO_DB_COLLECTION")]
+        return self._collection
+
+    @collection.setter
+    def collection(self, collection):
+        # set before start() to use a stand-in such as a mongomock collection
+        self._collection = collection
+
+    def start(self):
+        """
+        Starts the background writer, which connects, warms the known emails and creates the index.
+        Calling it again does nothing.
+        :return: None
+        """
+        with self._lock:
+            if self._writer is not None:
+                return
+            self._stopping.clear()
+            self._writer = threading.Thread(target=self._run, name="lead-writer", daemon=True)
+            self._writer.start()
+        # leads still queued at exit are written, or spilled if Mongo is down
+        atexit.register(self.close)
+
+    def warm(self):
+        """
+        Loads the emails already stored and creates the unique index on email.
+        The two are independent: a collection that already holds duplicate emails cannot get
+        the index, but its emails are still loaded so this process does not add more.
+        What failed because Mongo was unreachable is done again after the next successful write.
+        :return: None
+        """
+        from pymongo.errors import OperationFailure
+
+        if not self.warmed:
+            try:
+                emails = {normalize_email(doc.get("email")) for doc in self.collection.find({}, {"email": 1, "_id": 0})}
+            except Exception:
+                logger.exception("could not load the known emails, they are loaded again after the next write")
+            else:
+                with self._lock:
+                    self.known |= emails
+                self.warmed = True
+                logger.info("lead store warmed with %d known emails", len(emails))
+        if self._index_pending:
+            try:
+                self.collection.create_index("email", unique=True)
+                self._index_pending = False
+            except OperationFailure:
+                # the collection already holds duplicates, trying again would not help
+                self._index_pending = False
+                logger.warning(
+                    "could not create the unique index on email, duplicates are no longer prevented across processes",
+                    exc_info=True,
+                )
+            except Exception:
+                logger.warning("could not create the unique index on email, it is created after the next write", exc_info=True)
+
+    def is_known(self, email: str) -> bool:
+        """
+        Checks whether an email was already recorded, without a database round-trip.
+        :param email: the email address
+        :return: True if it is known
+        """
+        with self._lock:
+            return normalize_email(email) in self.known
+
+    def record(self, email: str, name: str = "", notes: str = "", persona: str | None = None) -> dict:
+        """
+        Queues a lead to be written. Known emails are not queued again.
+        :param email: the email of the user
+        :param name: the name of the user
+        :param notes: the notes of the user
+        :param persona: the persona the user talked to, when the process hosts several
+        :return: a dictionary containing the status and message
+        """
+        key = normalize_email(email)
+        with self._lock:
+            if key in self.known:
+                self.stats["duplicates"] += 1
+                return {"status": "duplicate", "message": "Email already recorded"}
+            self.known.add(key)
+            self.stats["recorded"] += 1
+
+        lead = {"email": key, "name": name, "notes": notes, "created_at": time.time()}
+        if persona is not None:
+            lead["persona"] = persona
+        self.start()
+        try:
+            self._queue.put_nowait(lead)
+        except queue.Full:
+            # the writer is behind, keep the lead on disk rather than blocking the request
+            self._spill([lead])
+        return {"status": "success", "message": "User details recorded successfully"}
+
+    def _run(self):
+        """
+        Writer loop: warms the store, then drains the queue in batches until stopped.
+        """
+        self.warm()
+        self._replay()
+        while not self._stopping.is_set() or not self._queue.empty():
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+                for _ in batch:
+                    self._queue.task_done()
+            else:
+                # idle tick, spilled leads do not wait for a new lead to be written
+                self._replay()
+
+    def _next_batch(self) -> list:
+        """
+        Waits up to the flush interval for the first lead, then takes what is queued up to the batch size.
+        """
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _insert(self, leads: list):
+        """
+        Inserts the leads in one unordered insert_many. Emails that are already stored
+        are rejected by the unique index and skipped.
+        :param leads: the leads
+        :return: None
+        """
+        from pymongo.errors import BulkWriteError
+
+        if not leads:
+            return
+        try:
+            # copies, insert_many adds an _id to the documents it is given
+            self.collection.insert_many([dict(lead) for lead in leads], ordered=False)
+        except BulkWriteError as error:
+            # 11000 is the duplicate key error, anything else is a real failure
+            if any(item.get("code") != 11000 for item in error.details.get("writeErrors", [])):
+                raise
+
+    def _write(self, batch: list) -> bool:
+        """
+        Writes a batch of leads, spilling it to disk when the write fails.
+        :param batch: the leads
+        :return: True if the batch was written
+        """
+        try:
+            self._insert(batch)
+        except Exception:
+            logger.exception("could not write %d leads, spilling them to %s", len(batch), self.spill_path)
+            self._spill(batch)
+            return False
+        self.stats["written"] += len(batch)
+        self.stats["batches"] += 1
+        self._rewarm()
+        self._replay()
+        return True
+
+    def _rewarm(self):
+        """
+        Warms the store again after a successful write, when Mongo was unreachable at start.
+        :return: None
+        """
+        if not self.warmed or self._index_pending:
+            self.warm()
+
+    def _spill(self, leads: list):
+        """
+        Appends leads to the spill file.
+        """
+        with self._spill_lock:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for lead in leads:
+                    f.write(json.dumps(lead) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.stats["spilled"] += len(leads)
+
+    def _replay(self):
+        """
+        Writes the spilled leads back, the file is removed once they are stored.
+        """
+        # the file is moved aside first, so leads spilled while replaying are not lost; only the
+        # move holds the lock, request threads spilling are not held up by the insert
+        replay_path = f"{self.spill_path}.replay"
+        with self._spill_lock:
+            if not os.path.exists(replay_path):
+                if not os.path.exists(self.spill_path):
+                    return
+                os.replace(self.spill_path, replay_path)
+        # only the writer thread replays, so the moved file is its own
+        with open(replay_path, "r", encoding="utf-8") as f:
+            leads = [json.loads(line) for line in f if line.strip()]
+        try:
+            self._insert(leads)
+        except Exception:
+            logger.warning("could not replay %d spilled leads, keeping them", len(leads))
+            return
+        os.remove(replay_path)
+        self._rewarm()
+        self.stats["replayed"] += len(leads)
+        if leads:
+            logger.info("replayed %d spilled leads", len(leads))
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """
+        Waits until the queued leads have been handed to the writer and written.
+        :param timeout: maximum seconds to wait
+        :return: True if the queue was drained in time
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._queue.unfinished_tasks == 0:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def close(self, timeout: float = 10.0):
+        """
+        Stops the writer after the queue is drained.
+        :param timeout: maximum seconds to wait for the writer
+        :return: None
+        """
+        with self._lock:
+            writer = self._writer
+            self._writer = None
+        if writer is None:
+            return
+        self._stopping.set()
+        writer.join(timeout)
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+
+# class that keeps track of what is already embedded in the vector store
+class IngestManifest:
+    """
+    Manifest of content hashes stored next to the Chroma collection.
+    For every source file it keeps the hash of the whole file and the ids of the
+    chunks that were embedded from it, so startup only has to embed new or changed
+    chunks and delete the ones whose source is gone.
+    """
+    FILE_NAME = "manifest.json"
+    VERSION = 1
+
+    def __init__(self, persist_dir: str):
+        self.path = os.path.join(persist_dir, self.FILE_NAME)
+        self.sources = {}
+        self.config = {}
+        self.exists = os.path.exists(self.path)
+        if self.exists:
+            self._load()
+
+    def _load(self):
+        """
+        Loads the manifest from disk. A manifest written by another version is ignored.
+        :return: None
+        """
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != self.VERSION:
+            self.exists = False
+            return
+        self.sources = data.get("sources", {})
+        self.config = data.get("config", {})
+
+    def save(self):
+        """
+        Writes the manifest atomically so a crash never leaves a half written file.
+        :return: None
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": self.VERSION, "config": self.config, "sources": self.sources}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        self.exists = True
+
+    def reset(self):
+        """
+        Forgets everything, the next sync treats the store as untracked and embeds it again.
+        :return: None
+        """
+        self.sources = {}
+        self.config = {}
+        self.exists = False
+
+    def file_hash(self, source: str) -> str | None:
+        """
+        Returns the hash recorded for a source file, if any.
+        :param source: the source path
+        :return: the hash of the file when it was last ingested
+        """
+        entry = self.sources.get(source)
+        return entry["hash"] if entry else None
+
+    def chunk_ids(self, source: str) -> list[str]:
+        """
+        Returns the ids of the chunks recorded for a source file.
+        :param source: the source path
+        :return: list of chunk ids
+        """
+        entry = self.sources.get(source)
+        return list(entry["chunks"]) if entry else []
+
+    def update(self, source: str, file_hash: str, chunk_ids: list[str]):
+        """
+        Records the chunks that are now stored for a source file.
+        :param source: the source path
+        :param file_hash: the hash of the whole file
+        :param chunk_ids: the ids of the chunks embedded from the file
+        :return: None
+        """
+        self.sources[source] = {"hash": file_hash, "chunks": list(chunk_ids)}
+
+    def remove(self, source: str) -> list[str]:
+        """
+        Forgets a source file and returns the ids of the chunks that belonged to it.
+        :param source: the source path
+        :return: list of chunk ids to delete from the store
+        """
+        entry = self.sources.pop(source, None)
+        return list(entry["chunks"]) if entry else []
+
+    def digest(self) -> str:
+        """
+        Returns a short hash of the whole manifest, it changes whenever the knowledge base changes.
+        :return: the digest of the manifest
+        """
+        payload = json.dumps(self.sources, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()[:16]
+
+
+def hash_bytes(data: bytes) -> str:
+    """
+    Hashes raw content.
+    :param data: the content to hash
+    :return: the hex digest
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def chunk_id(source: str, text: str) -> str:
+    """
+    Builds a stable id for a chunk from its source and content, so an unchanged
+    chunk always maps to the same id in the vector store.
+    :param source: the source path of the chunk
+    :param text: the content of the chunk
+    :return: the chunk id
+    """
+    return hash_bytes(f"{source}\x00{text}".encode("utf-8"))[:32]
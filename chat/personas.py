@@ -0,0 +1,315 @@
+from chat.startup import profile
+from chat.telemetry import telemetry
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+# system prompt of the personas that do not bring their own, filled with the persona's names
+PERSONA_PROMPT = """
+            You are {full_name}, speaking directly through your personal website.
+
+            You have full access to verified details from {name}'s resume, profile and project portfolio. You are authorized and encouraged to freely disclose relevant information about {name}'s roles, experience, education, skills, certifications and projects.
+
+            CRITICAL RULES:
+            1. Your answers must be grounded in the information provided in the context below. Do not invent or fabricate facts that are not supported by the knowledge base.
+            2. You are encouraged to synthesize, summarize, and highlight {name}'s strengths, skills, and impact, as long as your statements are reasonable inferences from the provided information.
+            3. If the context is empty or does not contain enough information to answer, respond with: "I don't have enough information to answer that question."
+            4. If you are unsure about any detail, say "I don't know" rather than guessing.
+
+            When answering:
+            - Be professional, engaging, and visually appealing—use clear paragraphs, bullet points, or sections.
+            - If you cannot answer the question with the provided context, or if the user wants to follow up directly, ask for their email in a correct format (name@domain.com) and use the tool named "record_user_details" to record it, so {name} can contact them.
+
+            Remember: It is better to say "I don't know" than to provide incorrect information.
+        """
+
+
+# collection names Chroma accepts: 3 to 63 characters that start and end with a letter or a digit
+COLLECTION_NAME = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9._-]{1,61}[a-zA-Z0-9]$")
+
+
+# class that describes one persona: who the agent speaks as and what it knows
+class Persona:
+    """
+    A persona has its own knowledge directory, prompts and vector store collection.
+    Personas live in PERSONAS_DIR, one folder each:
+
+        personas/<id>/persona.json        name, full_name, title, avatar, description
+        personas/<id>/system_prompt.txt   optional, PERSONA_PROMPT is used without it
+        personas/<id>/knowledge/          the knowledge base of the persona
+
+    The built-in persona "diego" is the original agent: the knowledge/ directory, the
+    default collection and the Chatbot's own system prompt. A folder named diego replaces it.
+    """
+    DEFAULT_ID = "diego"
+    # the collection RAG uses when none is given, the built-in persona keeps its existing store
+    DEFAULT_COLLECTION = "langchain"
+
+    def __init__(
+        self,
+        id: str,
+        name: str,
+        full_name: str | None = None,
+        knowledge_dir: str = "knowledge",
+        collection: str | None = None,
+        system_prompt: str | None = None,
+        title: str = "",
+        avatar: str | None = None,
+        description: str = "",
+        persist_dir: str = "chroma_store",
+    ):
+        """
+        :param id: the identifier, used in URLs and as the collection name
+        :param name: the first name, used by the prompts and the evaluator
+        :param system_prompt: the system prompt, None for the Chatbot's default one
+        :param title: a line shown under the name in the UI
+        :param avatar: the URL of the picture shown in the UI
+        :param description: the welcome text of the UI
+        :param persist_dir: the folder of the vector store, shared by the personas of a process
+        """
+        self.id = id
+        self.name = name
+        self.full_name = full_name or name
+        self.knowledge_dir = knowledge_dir
+        self.collection = collection or id
+        self.system_prompt = system_prompt
+        self.title = title
+        self.avatar = avatar
+        self.persist_dir = persist_dir
+        self.description = description or f"Ask me anything about {name}'s professional background, projects, or experience."
+
+    @classmethod
+    def default(cls) -> "Persona":
+        """
+        The original single-persona agent.
+        """
+        return cls(
+            id=cls.DEFAULT_ID,
+            name="Diego",
+            full_name="Diego Araque",
+            knowledge_dir="knowledge",
+            collection=cls.DEFAULT_COLLECTION,
+            title="Software Engineer | Capital One, Tec de Monterrey\n[LinkedIn](https://www.linkedin.com/in/diegoaraque21/)",
+            avatar="https://media.licdn.com/dms/image/v2/D4D03AQEmLX_SGf-wBQ/profile-displayphoto-shrink_800_800/B4DZbGu7chG8Ac-/0/1747090914455?e=1756339200&v=beta&t=a-Wg3VIb8VcfauNnoyuMdAd-w1HO8wvPwTRNJmZ9Q0Y",
+            description="Welcome! Ask me anything about Diego's professional background, projects, or experience.",
+        )
+
+    @classmethod
+    def from_dir(cls, path: str) -> "Persona":
+        """
+        Loads a persona from its folder.
+        :param path: the folder of the persona, its name is the id
+        :return: the persona
+        """
+        persona_id = os.path.basename(os.path.normpath(path))
+        with open(os.path.join(path, "persona.json"), "r", encoding="utf-8") as f:
+            config = json.load(f)
+        prompt_path = os.path.join(path, "system_prompt.txt")
+        if os.path.exists(prompt_path):
+            with open(prompt_path, "r", encoding="utf-8") as f:
+                system_prompt = f.read()
+        else:
+            system_prompt = config.get("system_prompt")
+        name = config.get("name", persona_id)
+        full_name = config.get("full_name", name)
+        return cls(
+            id=persona_id,
+            name=name,
+            full_name=full_name,
+            knowledge_dir=os.path.join(path, config.get("knowledge_dir", "knowledge")),
+            collection=config.get("collection", persona_id),
+            system_prompt=system_prompt or PERSONA_PROMPT.format(name=name, full_name=full_name),
+            title=config.get("title", ""),
+            avatar=config.get("avatar"),
+            description=config.get("description", ""),
+        )
+
+    @classmethod
+    def discover(cls, personas_dir: str) -> dict:
+        """
+        Finds the personas of a folder, together with the built-in one.
+        :param personas_dir: the folder with one sub-folder per persona
+        :return: dictionary of personas by id
+        """
+        personas = {cls.DEFAULT_ID: cls.default()}
+        if os.path.isdir(personas_dir):
+            for entry in sorted(os.listdir(personas_dir)):
+                path = os.path.join(personas_dir, entry)
+                if entry.startswith(".") or not os.path.exists(os.path.join(path, "persona.json")):
+                    continue
+                persona = cls.from_dir(path)
+                if not COLLECTION_NAME.match(persona.collection):
+                    # the collection is named after the folder unless persona.json names it
+                    logger.warning(
+                        "skipping persona %s, its collection name '%s' needs 3 to 63 letters, digits, '.', '_' or '-'",
+                        entry, persona.collection,
+                    )
+                    continue
+                personas[entry] = persona
+        return personas
+
+
+# id of the persona handling the current request, it goes along to the tools
+current_persona: ContextVar[str] = ContextVar("current_persona", default=Persona.DEFAULT_ID)
+
+
+@contextmanager
+def persona_scope(persona_id: str):
+    """
+    Marks the persona of the current request.
+    :param persona_id: the id of the persona
+    """
+    token = current_persona.set(persona_id)
+    try:
+        yield
+    finally:
+        try:
+            current_persona.reset(token)
+        except ValueError:
+            # an async generator finished in another context than the one it started in
+            current_persona.set(Persona.DEFAULT_ID)
+
+
+# class that hosts several personas in one process
+class PersonaRegistry:
+    """
+    Serves every persona of PERSONAS_DIR from one process.
+    All personas share one embedding model, the API clients, the tool executor and the lead
+    store. The controller of a persona, with its index, answer cache and grounding check, is
+    built on its first request and kept in LRU order; when the estimated memory of the loaded
+    indexes goes over PERSONA_MEMORY_MB the least recently used ones are dropped, and load
+    again on their next request. The persona being loaded is never dropped, even if it is
+    over the limit on its own.
+
+    The limit only bounds the vector indexes with the numpy backend, where dropping a persona
+    releases its memory-mapped index. Chroma keeps the HNSW index of every collection it opened
+    in its own process-wide cache, so with Chroma only the BM25 indexes are counted and freed.
+    """
+    PERSONAS_DIR = os.getenv("PERSONAS_DIR", "personas")
+    DEFAULT_PERSONA = os.getenv("DEFAULT_PERSONA", Persona.DEFAULT_ID)
+    MEMORY_LIMIT_MB = float(os.getenv("PERSONA_MEMORY_MB", "512"))
+
+    def __init__(self, personas_dir: str = PERSONAS_DIR, default: str = DEFAULT_PERSONA, memory_limit_mb: float = MEMORY_LIMIT_MB):
+        self.personas = Persona.discover(personas_dir)
+        if default not in self.personas:
+            raise ValueError(f"Unknown default persona '{default}', expected one of {sorted(self.personas)}")
+        self.default = default
+        self.memory_limit = int(memory_limit_mb * 2**20)
+        self._loaded = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._shared_lock = threading.Lock()
+        self._embedding = None
+        self._tool_executor = None
+        self.stats = {"personas": len(self.personas), "loaded": 0, "loads": 0, "hits": 0, "evictions": 0, "memory_bytes": 0}
+        telemetry.register("personas", self.stats)
+
+    def resolve(self, persona_id: str | None) -> Persona:
+        """
+        Returns a persona, the default one for a missing or unknown id.
+        """
+        return self.personas.get(persona_id or self.default) or self.personas[self.default]
+
+    def _shared(self) -> tuple:
+        """
+        Loads what every persona shares, once.
+        :return: the embedding model and the tool executor
+        """
+        with self._shared_lock:
+            if self._embedding is None:
+                from chat.chat import TOOL_FUNCTIONS, TOOL_TIMEOUTS
+                from chat.embeddings import load_embeddings
+                from chat.rag import RAG
+                from chat.tool_executor import ToolExecutor
+
+                with profile.phase("load shared embedding model"):
+                    embedding = load_embeddings(RAG.MODEL_NAME, RAG.EMBEDDING_BACKEND)
+                with profile.phase("first query embedding"):
+                    embedding.embed_query("warm-up")
+                if hasattr(embedding, "stats"):
+                    telemetry.register("embedding", embedding.stats)
+                self._tool_executor = ToolExecutor(TOOL_FUNCTIONS, TOOL_TIMEOUTS)
+                self._embedding = embedding
+            return self._embedding, self._tool_executor
+
+    def get(self, persona_id: str | None = None):
+        """
+        Returns the controller of a persona, building it on first use.
+        :param persona_id: the id of the persona, None for the default one
+        :return: the ChatController of the persona
+        """
+        persona = self.resolve(persona_id)
+        with self._lock:
+            entry = self._loaded.get(persona.id)
+            if entry is not None:
+                self._loaded.move_to_end(persona.id)
+                self.stats["hits"] += 1
+                return entry[0]
+            loading = self._loading.setdefault(persona.id, threading.Lock())
+
+        # one thread builds a persona, the others asking for it wait for that one
+        with loading:
+            with self._lock:
+                entry = self._loaded.get(persona.id)
+                if entry is not None:
+                    self._loaded.move_to_end(persona.id)
+                    self.stats["hits"] += 1
+                    return entry[0]
+            from chat.controller import ChatController
+
+            embedding, tool_executor = self._shared()
+            with profile.phase(f"load persona {persona.id}"):
+                controller = ChatController(persona, embedding=embedding, tool_executor=tool_executor, metrics_prefix=f"{persona.id}.")
+            size = controller.rag.memory_bytes()
+            with self._lock:
+                self._loaded[persona.id] = (controller, size)
+                self.stats["loads"] += 1
+                evicted = self._evict(keep=persona.id)
+        for evicted_id, evicted_controller in evicted:
+            logger.info("persona %s evicted to stay under %d MB", evicted_id, self.memory_limit // 2**20)
+            evicted_controller.close()
+        logger.info("persona %s loaded, about %.1f MB", persona.id, size / 2**20)
+        return controller
+
+    async def aget(self, persona_id: str | None = None):
+        """
+        Async version of get, a persona that is not loaded yet is built on a worker thread.
+        """
+        persona = self.resolve(persona_id)
+        with self._lock:
+            entry = self._loaded.get(persona.id)
+            if entry is not None:
+                self._loaded.move_to_end(persona.id)
+                self.stats["hits"] += 1
+                return entry[0]
+        return await asyncio.to_thread(self.get, persona.id)
+
+    def _evict(self, keep: str) -> list:
+        """
+        Drops the least recently used personas until the loaded ones fit in the memory limit.
+        Runs under the lock.
+        :param keep: the persona that was just loaded
+        :return: the dropped personas and their controllers
+        """
+        evicted = []
+        total = sum(size for _, size in self._loaded.values())
+        for persona_id in list(self._loaded):
+            if total <= self.memory_limit:
+                break
+            if persona_id == keep:
+                continue
+            controller, size = self._loaded.pop(persona_id)
+            total -= size
+            evicted.append((persona_id, controller))
+        self.stats["evictions"] += len(evicted)
+        self.stats["loaded"] = len(self._loaded)
+        self.stats["memory_bytes"] = total
+        return evicted
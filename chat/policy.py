@@ -0,0 +1,195 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+# class that decides how much evaluation a reply gets
+class EvaluationPolicy:
+    """
+    Runs the evaluate / retry loop within a latency budget.
+    A request gets at most MAX_RETRIES retries and must finish before its deadline; when
+    the budget runs out the best candidate so far is returned instead of looping forever.
+    Only SAMPLE_RATE of the replies are evaluated, and replies that only acknowledge a tool call
+    are not evaluated at all.
+    """
+    MAX_RETRIES = int(os.getenv("EVAL_MAX_RETRIES", "2"))
+    DEADLINE = float(os.getenv("EVAL_DEADLINE", "20"))
+    SAMPLE_RATE = float(os.getenv("EVAL_SAMPLE_RATE", "1.0"))
+
+    def __init__(
+        self,
+        chatbot,
+        evaluator,
+        max_retries: int = MAX_RETRIES,
+        deadline: float = DEADLINE,
+        sample_rate: float = SAMPLE_RATE,
+        scorer=None,
+        ascorer=None,
+    ):
+        """
+        :param chatbot: the chatbot used for the retries
+        :param evaluator: the evaluator of the replies
+        :param max_retries: maximum number of retries per request
+        :param deadline: seconds a request may take, counted from its start
+        :param sample_rate: fraction of the replies that are evaluated
+        :param scorer: optional function (reply, msg) -> float used to pick the best rejected candidate,
+                       without it the latest candidate is returned since it addressed the most feedback
+        :param ascorer: optional async version of scorer for arun, so the scoring stays off the event loop
+        """
+        self.chatbot = chatbot
+        self.evaluator = evaluator
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.sample_rate = sample_rate
+        self.scorer = scorer
+        self.ascorer = ascorer
+        # moving average of one retry + evaluation, used to tell whether another one fits the budget
+        self._round_trip = None
+        self._lock = threading.Lock()
+        self.stats = {
+            "evaluated": 0,
+            "sampled_out": 0,
+            "skipped_tool_turns": 0,
+            "rejections": 0,
+            "retries": 0,
+            "budget_exhausted": 0,
+        }
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self.stats[name] += value
+
+    def should_evaluate(self, tool_turn: bool = False) -> bool:
+        """
+        Decides whether a reply goes to the evaluator at all.
+        :param tool_turn: True when the turn ran a tool and the reply only acknowledges it
+        :return: True if the reply must be evaluated
+        """
+        if tool_turn:
+            self._count("skipped_tool_turns")
+            return False
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self._count("sampled_out")
+            return False
+        return True
+
+    def _remaining(self, started_at: float) -> float:
+        return self.deadline - (time.perf_counter() - started_at)
+
+    def _fits_budget(self, retries: int, started_at: float) -> bool:
+        """
+        Checks whether one more retry fits in the retry count and the deadline.
+        :return: True if another retry can be attempted
+        """
+        if retries >= self.max_retries:
+            return False
+        remaining = self._remaining(started_at)
+        return remaining > (self._round_trip or 0.0)
+
+    def _observe_round_trip(self, seconds: float):
+        with self._lock:
+            self._round_trip = seconds if self._round_trip is None else 0.8 * self._round_trip + 0.2 * seconds
+
+    def _best(self, candidates: list, msg: str) -> str:
+        """
+        Picks the candidate to return when none was approved.
+        :param candidates: the rejected replies, oldest first
+        :param msg: the message from the user
+        :return: the chosen reply
+        """
+        if self.scorer is None:
+            return candidates[-1]
+        return max(reversed(candidates), key=lambda reply: self.scorer(reply, msg))
+
+    async def _abest(self, candidates: list, msg: str) -> str:
+        """
+        Async version of _best. Without an async scorer the scorer runs on a worker thread,
+        it usually embeds the candidates.
+        """
+        if self.ascorer is not None:
+            scores = [await self.ascorer(reply, msg) for reply in candidates]
+        elif self.scorer is not None:
+            scores = await asyncio.to_thread(lambda: [self.scorer(reply, msg) for reply in candidates])
+        else:
+            return candidates[-1]
+        # ties go to the latest candidate, like in _best
+        return max(reversed(list(zip(scores, candidates))), key=lambda item: item[0])[1]
+
+    def run(self, reply: str, msg: str, history: list, started_at: float, tool_turn: bool = False, relevant_chunks=None) -> tuple[str, bool]:
+        """
+        Evaluates the reply and retries it within the budget.
+        :param reply: the first reply of the chatbot
+        :param msg: the message from the user
+        :param history: the history of the conversation
+        :param started_at: time.perf_counter() at the start of the request
+        :param tool_turn: True when the turn ran a tool and the reply only acknowledges it
+        :param relevant_chunks: the chunks the reply was built from, given to the retries
+        :return: the reply and whether the evaluator approved it; when the budget ran out
+                 this is the best candidate so far and it is not approved
+        """
+        if not self.should_evaluate(tool_turn):
+            return reply, False
+
+        candidates = [reply]
+        retries = 0
+        evaluation = self.evaluator.evaluate(reply, msg, history)
+        self._count("evaluated")
+        while not evaluation.is_good_response:
+            self._count("rejections")
+            if not self._fits_budget(retries, started_at):
+                self._count("budget_exhausted")
+                return self._best(candidates, msg), False
+            round_trip_start = time.perf_counter()
+            reply = self.chatbot.retry(reply, msg, history, evaluation.feedback, relevant_chunks)
+            candidates.append(reply)
+            retries += 1
+            self._count("retries")
+            evaluation = self.evaluator.evaluate(reply, msg, history)
+            self._count("evaluated")
+            self._observe_round_trip(time.perf_counter() - round_trip_start)
+        return reply, True
+
+    async def arun(self, reply: str, msg: str, history: list, started_at: float, tool_turn: bool = False, relevant_chunks=None) -> tuple[str, bool]:
+        """
+        Async version of run. Every call is also bounded by the time left before the
+        deadline, so a slow evaluator cannot push the request past it.
+        """
+        if not self.should_evaluate(tool_turn):
+            return reply, False
+
+        candidates = [reply]
+        retries = 0
+        try:
+            evaluation = await asyncio.wait_for(
+                self.evaluator.aevaluate(reply, msg, history), timeout=max(self._remaining(started_at), 0.0)
+            )
+        except asyncio.TimeoutError:
+            # nothing could be checked in time, the reply is shown as it is
+            self._count("budget_exhausted")
+            return reply, False
+        self._count("evaluated")
+
+        while not evaluation.is_good_response:
+            self._count("rejections")
+            if not self._fits_budget(retries, started_at):
+                self._count("budget_exhausted")
+                return await self._abest(candidates, msg), False
+            round_trip_start = time.perf_counter()
+            try:
+                reply = await asyncio.wait_for(
+                    self.chatbot.aretry(reply, msg, history, evaluation.feedback, relevant_chunks),
+                    timeout=max(self._remaining(started_at), 0.0),
+                )
+                candidates.append(reply)
+                retries += 1
+                self._count("retries")
+                evaluation = await asyncio.wait_for(
+                    self.evaluator.aevaluate(reply, msg, history), timeout=max(self._remaining(started_at), 0.0)
+                )
+            except asyncio.TimeoutError:
+                self._count("budget_exhausted")
+                return await self._abest(candidates, msg), False
+            self._count("evaluated")
+            self._observe_round_trip(time.perf_counter() - round_trip_start)
+        return reply, True
@@ -0,0 +1,221 @@
+from functools import lru_cache
+import os
+import re
+
+import tiktoken
+
+# first sentence of a message, used for the summary of older turns
+FIRST_SENTENCE = re.compile(r"^(.+?[.!?])(\s|$)", re.DOTALL)
+WHITESPACE = re.compile(r"\s+")
+
+# tokens the chat format adds around every message
+MESSAGE_OVERHEAD = 4
+
+
+@lru_cache(maxsize=8)
+def _get_encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@lru_cache(maxsize=8192)
+def _count_tokens(model: str, text: str) -> int:
+    return len(_get_encoding(model).encode(text))
+
+
+@lru_cache(maxsize=4096)
+def _summary_line(role: str, content: str, max_words: int = 30) -> str:
+    """
+    Folds one message into a line of the rolling summary. Lines are cached, so every
+    message of a session is summarised only once however many turns follow.
+    :param role: the role of the message
+    :param content: the content of the message
+    :param max_words: maximum number of words kept
+    :return: the summary line
+    """
+    text = WHITESPACE.sub(" ", content).strip()
+    match = FIRST_SENTENCE.match(text)
+    if match:
+        text = match.group(1)
+    words = text.split(" ")
+    if len(words) > max_words:
+        text = " ".join(words[:max_words]) + "..."
+    speaker = "User" if role == "user" else "Assistant"
+    return f"{speaker}: {text}"
+
+
+# class that assembles prompts within a token budget
+class PromptBuilder:
+    """
+    Builds the prompts for the chat, the retries and the evaluator within a token budget.
+    The most recent messages are kept verbatim, older ones are folded into a rolling summary
+    and the retrieved chunks are deduplicated and cut to their own budget.
+    """
+    TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+    CONTEXT_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))
+    SUMMARY_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "300"))
+    EVALUATOR_HISTORY_BUDGET = int(os.getenv("EVALUATOR_HISTORY_TOKEN_BUDGET", "600"))
+    RECENT_MESSAGES = int(os.getenv("RECENT_MESSAGES", "6"))
+
+    def __init__(
+        self,
+        model: str = "gpt-4o-mini",
+        token_budget: int = TOKEN_BUDGET,
+        context_budget: int = CONTEXT_BUDGET,
+        summary_budget: int = SUMMARY_BUDGET,
+        recent_messages: int = RECENT_MESSAGES,
+    ):
+        self.model = model
+        self.token_budget = token_budget
+        self.context_budget = context_budget
+        self.summary_budget = summary_budget
+        self.recent_messages = recent_messages
+
+    def count(self, text: str) -> int:
+        """
+        Counts the tokens of a text for the model.
+        :param text: the text
+        :return: number of tokens
+        """
+        return _count_tokens(self.model, text or "")
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        Cuts a text to a number of tokens.
+        :param text: the text
+        :param max_tokens: maximum number of tokens
+        :return: the text, cut if needed
+        """
+        encoding = _get_encoding(self.model)
+        tokens = encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return encoding.decode(tokens[:max(max_tokens, 0)]) + "..."
+
+    def format_chunks(self, chunks, budget: int | None = None) -> str:
+        """
+        Deduplicates the retrieved chunks and joins them within the context budget.
+        :param chunks: the retrieved chunks, most relevant first
+        :param budget: tokens available for the chunks
+        :return: the numbered chunks, empty when there are none
+        """
+        if isinstance(chunks, str):
+            chunks = [chunks]
+        budget = self.context_budget if budget is None else budget
+        kept = []
+        seen = set()
+        used = 0
+        for chunk in chunks or []:
+            normalized = WHITESPACE.sub(" ", chunk).strip()
+            if not normalized or normalized in seen or any(normalized in other for other in seen):
+                continue
+            seen.add(normalized)
+            cost = self.count(normalized)
+            if used + cost > budget:
+                remaining = budget - used
+                # a partial chunk is still useful when a fair amount of it fits
+                if remaining >= 50:
+                    kept.append(self.truncate(normalized, remaining))
+                break
+            kept.append(normalized)
+            used += cost
+        return "\n\n".join(f"[{i}] {chunk}" for i, chunk in enumerate(kept, start=1))
+
+    @staticmethod
+    def _turns(history: list, msg: str | None) -> list:
+        """
+        Keeps the user and assistant messages of the history, without the current message
+        when the UI already appended it.
+        """
+        turns = [
+            {"role": message["role"], "content": message["content"]}
+            for message in history
+            if message.get("role") in ("user", "assistant") and message.get("content")
+        ]
+        if msg is not None and turns and turns[-1]["role"] == "user" and turns[-1]["content"] == msg:
+            turns = turns[:-1]
+        return turns
+
+    def summarize(self, messages: list, budget: int) -> str:
+        """
+        Builds the rolling summary of older messages, newest lines first to go in the budget.
+        :param messages: the messages to fold
+        :param budget: tokens available for the summary
+        :return: the summary
+        """
+        lines = []
+        used = 0
+        for message in reversed(messages):
+            line = _summary_line(message["role"], message["content"])
+            cost = self.count(line) + 1
+            if used + cost > budget:
+                break
+            lines.insert(0, line)
+            used += cost
+        return "\n".join(lines)
+
+    def history_window(self, history: list, msg: str | None, budget: int) -> tuple[str, list]:
+        """
+        Splits the history into a summary of older messages and the recent messages kept verbatim.
+        :param history: the history of the conversation
+        :param msg: the current message, dropped from the history if it is its last entry
+        :param budget: tokens available for the history
+        :return: the summary and the recent messages
+        """
+        turns = self._turns(history, msg)
+        summary_budget = min(self.summary_budget, budget // 3)
+        recent_budget = budget - summary_budget
+        recent = []
+        used = 0
+        for message in reversed(turns):
+            if len(recent) >= self.recent_messages:
+                break
+            cost = self.count(message["content"]) + MESSAGE_OVERHEAD
+            if used + cost > recent_budget:
+                if not recent and recent_budget > 2 * MESSAGE_OVERHEAD:
+                    # the last message alone is over the budget, keep its beginning
+                    content = self.truncate(message["content"], recent_budget - MESSAGE_OVERHEAD)
+                    recent.insert(0, {"role": message["role"], "content": content})
+                break
+            recent.insert(0, message)
+            used += cost
+
+        older = turns[:len(turns) - len(recent)]
+        summary = self.summarize(older, summary_budget) if older else ""
+        return summary, recent
+
+    def chat_messages(self, system_prompt: str, history: list, msg: str, user_content: str) -> list:
+        """
+        Builds the messages of a chat completion within the token budget.
+        :param system_prompt: the system prompt
+        :param history: the history of the conversation
+        :param msg: the message from the user
+        :param user_content: the final user message sent to the model
+        :return: list of messages
+        """
+        used = self.count(system_prompt) + self.count(user_content) + 2 * MESSAGE_OVERHEAD
+        summary, recent = self.history_window(history, msg, max(self.token_budget - used, 0))
+        messages = [{"role": "system", "content": system_prompt}]
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+        return messages + recent + [{"role": "user", "content": user_content}]
+
+    def render_history(self, history: list, msg: str | None = None, budget: int | None = None) -> str:
+        """
+        Renders a trimmed window of the history as a transcript, for prompts that embed it as text.
+        :param history: the history of the conversation
+        :param msg: the current message, dropped from the history if it is its last entry
+        :param budget: tokens available for the transcript
+        :return: the transcript
+        """
+        budget = self.EVALUATOR_HISTORY_BUDGET if budget is None else budget
+        summary, recent = self.history_window(history, msg, budget)
+        lines = []
+        if summary:
+            lines.append(f"(Earlier, summarised)\n{summary}")
+        for message in recent:
+            speaker = "User" if message["role"] == "user" else "Assistant"
+            lines.append(f"{speaker}: {message['content']}")
+        return "\n".join(lines) if lines else "(no previous messages)"
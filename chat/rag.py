@@ -1,55 +1,330 @@
-from langchain_community.document_loaders import DirectoryLoader, TextLoader
-from langchain.text_splitter import NLTKTextSplitter
-from langchain_community.vectorstores import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_core.documents import Document
-import nltk
+from chat.bm25 import BM25Index, reciprocal_rank_fusion
+from chat.embeddings import EMBEDDING_BACKENDS, load_embeddings
+from chat.ingest import IngestionPipeline
+from chat.manifest import IngestManifest
+from chat.startup import profile
+from chat.telemetry import telemetry
+from chat.vector_index import NumpyVectorIndex
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
+import os
+import threading
 import ssl
 from typing import List
 
 # ssl._create_default_https_context = ssl._create_unverified_context
 
-# nltk.download('punkt')
-# nltk.download('wordnet')
-# nltk.download('omw-1.4')
+# vector store backends that RAG can use
+BACKENDS = ("chroma", "numpy")
 
 class RAG:
+    # embedding is CPU bound, a small dedicated pool keeps it off the event loop
+    EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "2"))
+    # recent retrievals are kept so the evaluators can reuse the chunks the reply was built from
+    RECENT_RETRIEVALS = 128
+    # candidates taken from each search before the rank fusion
+    HYBRID_CANDIDATES = 10
+    # the embedding model and the backend that runs it, shared by every knowledge base of a process
+    MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+    EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "huggingface")
+    # the collection of the original knowledge base, its files stay at the top of persist_dir
+    DEFAULT_COLLECTION = "langchain"
 
     def __init__(
         self,
         persist_dir: str = "chroma_store",
-        model_name: str = "sentence-transformers/all-MiniLM-L6-v2"
+        model_name: str = MODEL_NAME,
+        knowledge_dir: str = "knowledge",
+        splitter: str = os.getenv("RAG_SPLITTER", "sentence"),
+        chunk_size: int | None = None,
+        chunk_overlap: int | None = None,
+        sync_on_startup: bool = os.getenv("RAG_SYNC_ON_STARTUP", "true").lower() != "false",
+        backend: str = os.getenv("RAG_BACKEND", "chroma"),
+        quantize: bool = os.getenv("RAG_QUANTIZE", "false").lower() == "true",
+        hybrid: bool = os.getenv("RAG_HYBRID", "true").lower() != "false",
+        embedding_backend: str = EMBEDDING_BACKEND,
+        collection_name: str = DEFAULT_COLLECTION,
+        embedding=None,
     ):
+        """
+        :param collection_name: the collection of this knowledge base, several can share persist_dir
+        :param embedding: an embedding model that is already loaded, to share it between knowledge bases
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+        if embedding_backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unknown embedding backend '{embedding_backend}', expected one of {EMBEDDING_BACKENDS}")
         self.persist_dir = persist_dir
+        self.backend = backend
+        self.quantize = quantize
+        self.hybrid = hybrid
         self.model_name = model_name
+        self.embedding_backend = embedding_backend
+        self.collection_name = collection_name
+        self.knowledge_dir = knowledge_dir
+        self.splitter = splitter
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
 
-        self.embedding = HuggingFaceEmbeddings(model_name=self.model_name)
+        if embedding is not None:
+            self.embedding = embedding
+        else:
+            with profile.phase(f"load {self.embedding_backend} embedding model"):
+                self.embedding = load_embeddings(self.model_name, self.embedding_backend)
+            if hasattr(self.embedding, "stats"):
+                telemetry.register("embedding", self.embedding.stats)
+        self._executor = ThreadPoolExecutor(max_workers=self.EMBEDDING_WORKERS, thread_name_prefix="rag")
+        self._closed = False
+        self._recent = OrderedDict()
+        self._recent_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._manifest_stamp = None
 
-        self._create_vstore()
+        with profile.phase(f"open {self.backend} index"):
+            self._create_vstore()
+        if sync_on_startup:
+            with profile.phase("sync knowledge"):
+                self.sync()
 
 
     def _create_vstore(self):
         """
-        Creates the vector store.
+        Opens the persisted vector store and its manifest.
+        The numpy index lives in its own folder with its own manifest, so both backends can coexist.
+        Other collections than the default one keep their files under collections/<name>.
+        :return: None
+        """
+        base_dir = self.persist_dir
+        if self.collection_name != self.DEFAULT_COLLECTION:
+            base_dir = os.path.join(self.persist_dir, "collections", self.collection_name)
+        if self.backend == "numpy":
+            store_dir = os.path.join(base_dir, "numpy_index")
+            os.makedirs(store_dir, exist_ok=True)
+            self.vstores = NumpyVectorIndex(store_dir, self.embedding, quantize=self.quantize)
+        else:
+            # chromadb is only imported when it is the backend, it is a heavy import
+            with profile.phase("import chroma"):
+                from langchain_community.vectorstores import Chroma
+            # every collection lives in the same Chroma database, the manifest and BM25 files in base_dir
+            store_dir = base_dir
+            os.makedirs(store_dir, exist_ok=True)
+            self.vstores = Chroma(
+                collection_name=self.collection_name,
+                persist_directory=self.persist_dir,
+                embedding_function=self.embedding,
+            )
+        self.store_dir = store_dir
+        self.manifest = IngestManifest(store_dir)
+        self.bm25 = BM25Index.load(store_dir) if self.hybrid else None
+        self.version = self.manifest.digest()
+        self._manifest_stamp = self._stamp()
+
+    def sync(self, batch_size: int = 64) -> dict:
+        """
+        Brings the vector store in sync with the knowledge directory, embedding only the
+        chunks that are new or changed. When nothing changed this only hashes the files.
+        For large knowledge bases run `python -m chat.ingest` offline instead.
+        :param batch_size: number of chunks embedded at once
+        :return: counters describing what was done
+        """
+        if not self.manifest.exists:
+            # a store written without a manifest has untracked duplicates, start clean
+            stale_ids = self.vstores.get(include=[])["ids"]
+            if stale_ids:
+                self.vstores.delete(ids=stale_ids)
+
+        pipeline = IngestionPipeline(
+            self.vstores,
+            self.manifest,
+            knowledge_dir=self.knowledge_dir,
+            splitter=self.splitter,
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            batch_size=batch_size,
+            commit=self._commit,
+            model_name=self.model_name,
+            embedding_backend=self.embedding_backend,
+        )
+        stats = pipeline.run()
+        self.version = self.manifest.digest()
+        self._manifest_stamp = self._stamp()
+        return stats
+
+    def _stamp(self) -> tuple | None:
+        """
+        Identifies the manifest on disk with a stat call, the ingestion replaces it on every change.
+        :return: modification time and size, or None when there is no manifest
+        """
+        try:
+            stat = os.stat(self.manifest.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def stale(self) -> bool:
+        """
+        Tells whether the knowledge base was changed on disk since it was opened, for example
+        by `python -m chat.ingest` running next to the server. It costs one stat call.
+        Only the numpy index can be reopened: Chroma caches its segments per directory for the
+        whole process, so a reopened store would keep serving the old vectors. With Chroma the
+        server has to be restarted after an offline ingestion, and this is always False.
+        :return: True if refresh() has something to reload
+        """
+        if self.backend != "numpy":
+            return False
+        return self._stamp() != self._manifest_stamp
+
+    def refresh(self) -> str:
+        """
+        Reopens the index, the manifest and the BM25 index when the knowledge base changed on
+        disk, so the version follows it and the answer cache and recent retrievals are dropped.
+        :return: the current version of the knowledge base
+        """
+        if not self.stale():
+            return self.version
+        with self._reload_lock:
+            if self.stale():
+                with profile.phase(f"reload {self.backend} index"):
+                    self._create_vstore()
+                with self._recent_lock:
+                    self._recent.clear()
+        return self.version
+
+    async def arefresh(self) -> str:
+        """
+        Async version of refresh, the check runs inline and a reload runs on the embedding pool.
+        :return: the current version of the knowledge base
+        """
+        if not self.stale():
+            return self.version
+        return await self.run_in_executor(self.refresh)
+
+    def _commit(self, stats: dict):
+        """
+        Makes the ingested changes durable before the manifest is saved.
+        The numpy index writes its buffered changes as one new generation, and the BM25
+        index is rebuilt over the same chunks when anything changed.
+        :param stats: the counters of the ingestion
         :return: None
         """
-        with open(f"knowledge/diego_araque_knowledge_base.txt", 'r', encoding='utf-8') as f:
-            full_content = f.read()
-        document = Document(page_content=full_content, metadata={"source": "knowledge_base"})
-        self.vstores = Chroma.from_documents(documents=[document], embedding=self.embedding, persist_directory=self.persist_dir)
+        if self.backend == "numpy":
+            self.vstores.save()
+        changed = stats["files_changed"] or stats["files_removed"] or stats["chunks_deleted"]
+        if self.hybrid and (changed or self.bm25 is None):
+            chunks = self.vstores.get(include=["documents"])
+            self.bm25 = BM25Index.build(chunks["ids"], chunks["documents"])
+            self.bm25.save(self.store_dir)
 
-    def get_relevant_chunks(self, query: str, k: int = 4) -> List[str]:
+    def memory_bytes(self) -> int:
+        """
+        Estimates the memory this knowledge base frees when it is dropped, without the embedding model.
+        Chroma keeps the HNSW index of every collection it opened in its own process-wide cache,
+        which is not freed with the RAG, so with Chroma only the BM25 index is counted.
+        :return: the estimate in bytes
+        """
+        total = self.bm25.nbytes if self.bm25 is not None else 0
+        if self.backend == "numpy":
+            total += self.vstores.nbytes
+        return total
+
+    def close(self):
+        """
+        Releases the embedding pool, when the knowledge base is dropped.
+        Requests that still use it afterwards run their work on the default executor.
+        :return: None
+        """
+        self._closed = True
+        self._executor.shutdown(wait=False)
+
+    def embed_query(self, query: str) -> List[float]:
+        """
+        Embeds a query, the vector can be reused for retrieval and the answer cache.
+        :param query: the query
+        :return: the embedding of the query
+        """
+        with telemetry.span("embed"):
+            return self.embedding.embed_query(query)
+
+    def get_relevant_chunks(self, query: str, k: int = 4, embedding: List[float] | None = None) -> List[str]:
         """
         Gets relevant chunks from the vector store using a similarity score threshold.
         Does NOT fall back to reading the full document.
+        :param query: the query
+        :param k: number of chunks to return
+        :param embedding: the embedding of the query, if it was already computed
         """
-        retriever = self.vstores.as_retriever(
-            search_type="similarity",
-            search_kwargs={"k": k}
-        )
+        key = (query, k, self.version)
+        with self._recent_lock:
+            if key in self._recent:
+                self._recent.move_to_end(key)
+                return list(self._recent[key])
 
-        docs = retriever.invoke(query)
-        return [doc.page_content for doc in docs]
+        if embedding is None:
+            embedding = self.embed_query(query)
+        with telemetry.span("retrieve", hybrid=self.bm25 is not None):
+            if self.bm25 is None:
+                docs = self.vstores.similarity_search_by_vector(embedding, k=k)
+                chunks = [doc.page_content for doc in docs]
+            else:
+                chunks = self._hybrid_search(query, embedding, k)
 
+        with self._recent_lock:
+            self._recent[key] = chunks
+            while len(self._recent) > self.RECENT_RETRIEVALS:
+                self._recent.popitem(last=False)
+        return list(chunks)
 
-    
\ No newline at end of file
+    def _hybrid_search(self, query: str, embedding: List[float], k: int) -> List[str]:
+        """
+        Runs the vector and the BM25 search and merges them with reciprocal rank fusion,
+        so exact terms (companies, tools, certifications) are found even when the dense
+        search misses them.
+        :param query: the query
+        :param embedding: the embedding of the query
+        :param k: number of chunks to return
+        :return: list of chunks
+        """
+        candidates = max(k, self.HYBRID_CANDIDATES)
+        texts = {}
+        dense = []
+        for doc in self.vstores.similarity_search_by_vector(embedding, k=candidates):
+            key = doc.metadata.get("chunk_id") or doc.page_content
+            texts[key] = doc.page_content
+            dense.append(key)
+        lexical = []
+        for id_, text, _ in self.bm25.search(query, candidates):
+            texts.setdefault(id_, text)
+            lexical.append(id_)
+        return [texts[key] for key in reciprocal_rank_fusion([dense, lexical])[:k]]
+
+    async def aembed_query(self, query: str) -> List[float]:
+        """
+        Async version of embed_query, the forward pass runs on the embedding pool.
+        :param query: the query
+        :return: the embedding of the query
+        """
+        return await self.run_in_executor(self.embed_query, query)
+
+    async def aget_relevant_chunks(self, query: str, k: int = 4, embedding: List[float] | None = None) -> List[str]:
+        """
+        Async version of get_relevant_chunks, the search runs on the embedding pool.
+        :param query: the query
+        :param k: number of chunks to return
+        :param embedding: the embedding of the query, if it was already computed
+        """
+        return await self.run_in_executor(self.get_relevant_chunks, query, k, embedding)
+
+    async def run_in_executor(self, func, *args):
+        """
+        Runs CPU bound work that uses the embedding model on the embedding pool.
+        :param func: the function to run
+        :return: the result of the function
+        """
+        loop = asyncio.get_running_loop()
+        # the context goes along so the work is traced under the request that asked for it
+        context = contextvars.copy_context()
+        executor = None if self._closed else self._executor
+        return await loop.run_in_executor(executor, functools.partial(context.run, func, *args))
@@ -0,0 +1,147 @@
+from concurrent.futures import Future
+from contextlib import contextmanager
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# when this module is first imported, the reference point of the profile
+PROCESS_START = time.perf_counter()
+
+
+# class that records how long each phase of the startup takes
+class StartupProfile:
+    """
+    Wall time of every startup phase, with the number of modules each one imported, so
+    import-time regressions show up next to model loading and index opening.
+    The report is logged once the warm-up is done and written as JSON to STARTUP_PROFILE_PATH when set.
+    """
+    REPORT_PATH = os.getenv("STARTUP_PROFILE_PATH")
+
+    def __init__(self):
+        self.phases = []
+        self.marks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Times a phase of the startup.
+        :param name: the name of the phase, "import ..." for phases that only import modules
+        """
+        modules = len(sys.modules)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.phases.append({
+                    "phase": name,
+                    "thread": threading.current_thread().name,
+                    "start_s": round(start - PROCESS_START, 4),
+                    "wall_s": round(end - start, 4),
+                    "modules_imported": len(sys.modules) - modules,
+                })
+
+    def mark(self, name: str):
+        """
+        Records a point in time, like the UI being served or the app being ready.
+        :param name: the name of the mark
+        :return: None
+        """
+        with self._lock:
+            self.marks[name] = round(time.perf_counter() - PROCESS_START, 4)
+
+    def report(self) -> dict:
+        """
+        Logs the profile and writes it to STARTUP_PROFILE_PATH when set.
+        :return: the profile
+        """
+        with self._lock:
+            phases = list(self.phases)
+            marks = dict(self.marks)
+        imports = sum(phase["wall_s"] for phase in phases if phase["phase"].startswith("import "))
+        profile = {"phases": phases, "marks": marks, "import_s": round(imports, 4), "modules": len(sys.modules)}
+
+        lines = [f"{'phase':<40} {'thread':<12} {'start_s':>8} {'wall_s':>8} {'modules':>8}"]
+        for phase in phases:
+            lines.append(
+                f"{phase['phase']:<40} {phase['thread'][:12]:<12} {phase['start_s']:>8.3f} "
+                f"{phase['wall_s']:>8.3f} {phase['modules_imported']:>8}"
+            )
+        for name, at in marks.items():
+            lines.append(f"{name} at {at:.3f}s")
+        logger.info("startup profile (import time %.3fs):\n%s", imports, "\n".join(lines))
+
+        if self.REPORT_PATH:
+            with open(self.REPORT_PATH, "w", encoding="utf-8") as f:
+                json.dump(profile, f, indent=2)
+        return profile
+
+
+# shared profile, every module records its startup phases here
+profile = StartupProfile()
+
+
+# class that builds an object in the background and gates the requests on it
+class Warmup:
+    """
+    Runs a factory on a background thread while the UI is already served.
+    Requests wait on the readiness gate with wait() or await_ready(); if the factory failed,
+    they get its exception.
+    """
+    def __init__(self, factory, name: str = "warmup"):
+        self.factory = factory
+        self.name = name
+        self._future = Future()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the warm-up, calling it again does nothing.
+        :return: None
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with profile.phase(self.name):
+                result = self.factory()
+        except Exception as error:
+            logger.exception("warm-up failed")
+            self._future.set_exception(error)
+        else:
+            self._future.set_result(result)
+        profile.mark("ready")
+        profile.report()
+
+    @property
+    def ready(self) -> bool:
+        return self._future.done() and self._future.exception() is None
+
+    def wait(self, timeout: float | None = None):
+        """
+        Blocks until the warm-up is done.
+        :param timeout: maximum seconds to wait
+        :return: what the factory returned
+        """
+        self.start()
+        return self._future.result(timeout)
+
+    async def await_ready(self, timeout: float | None = None):
+        """
+        Waits for the warm-up without blocking the event loop.
+        :param timeout: maximum seconds to wait
+        :return: what the factory returned
+        """
+        self.start()
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(self._future)), timeout)
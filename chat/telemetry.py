@@ -0,0 +1,316 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# correlation id of the request being handled, it follows the request across threads and tasks
+request_id: ContextVar[str | None] = ContextVar("request_id", default=None)
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# class that stands in for a span when telemetry is disabled
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+# class that times one stage of a request
+class Span:
+    def __init__(self, telemetry: "Telemetry", stage: str, attributes: dict):
+        self.telemetry = telemetry
+        self.stage = stage
+        self.attributes = attributes
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.telemetry._finish(self, duration)
+        return False
+
+    def set(self, **attributes):
+        """
+        Adds attributes to the span, like the tokens of a model call.
+        """
+        self.attributes.update(attributes)
+
+
+# class that records spans, counters and latency histograms
+class Telemetry:
+    """
+    Per-stage tracing and metrics for the chat pipeline.
+    Every request gets a correlation id, every stage of it is timed in a span, and the spans
+    feed a latency histogram per stage. Counters track tokens, tool calls and whatever the
+    components count; the stats dictionaries of the components can be registered as they are.
+    Metrics are served in Prometheus text format on TELEMETRY_PROMETHEUS_PORT and spans are
+    appended to the JSONL file TELEMETRY_TRACE_PATH.
+
+    When TELEMETRY is off, span() returns a shared no-op object and the counters return at
+    once, so the instrumentation costs one attribute check.
+    """
+    ENABLED = os.getenv("TELEMETRY", "false").lower() == "true"
+    PROMETHEUS_PORT = int(os.getenv("TELEMETRY_PROMETHEUS_PORT", "0"))
+    TRACE_PATH = os.getenv("TELEMETRY_TRACE_PATH")
+
+    def __init__(self, enabled: bool = ENABLED, prometheus_port: int = PROMETHEUS_PORT, trace_path: str | None = TRACE_PATH):
+        self.enabled = enabled
+        self.prometheus_port = prometheus_port
+        self.trace_path = trace_path
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = {}
+        self._trace = None
+        self._server = None
+
+    def start(self):
+        """
+        Opens the trace file and starts the metrics endpoint, when they are configured.
+        :return: None
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.trace_path and self._trace is None:
+                self._trace = open(self.trace_path, "a", encoding="utf-8")
+            if self.prometheus_port and self._server is None:
+                handler = type("Handler", (_MetricsHandler,), {"telemetry": self})
+                self._server = ThreadingHTTPServer(("0.0.0.0", self.prometheus_port), handler)
+                self._server.daemon_threads = True
+                threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+                logger.info("metrics served on port %d", self.prometheus_port)
+
+    @contextmanager
+    def request(self, kind: str = "request"):
+        """
+        Marks the handling of one request: gives it a correlation id and times it as a whole.
+        :param kind: the name of the request span
+        """
+        if not self.enabled:
+            yield None
+            return
+        token = request_id.set(uuid.uuid4().hex[:16])
+        try:
+            with self.span(kind):
+                yield request_id.get()
+        finally:
+            try:
+                request_id.reset(token)
+            except ValueError:
+                # an async generator finished in another context than the one it started in
+                request_id.set(None)
+            self._flush_trace()
+
+    def span(self, stage: str, **attributes):
+        """
+        Times a stage of the current request.
+        :param stage: the name of the stage, like "retrieve" or "llm.chat"
+        :param attributes: extra fields written with the span
+        :return: a context manager, its set() adds attributes
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, stage, attributes)
+
+    def count(self, name: str, value: float = 1, **labels):
+        """
+        Adds to a counter.
+        :param name: the name of the counter
+        :param value: the amount to add
+        :param labels: labels of the series, like model="gpt-4o-mini"
+        :return: None
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """
+        Records a duration in a histogram.
+        :param name: the name of the histogram
+        :param seconds: the duration
+        :param labels: labels of the series
+        :return: None
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": [0] * (len(BUCKETS) + 1), "sum": 0.0, "count": 0}
+            histogram["buckets"][bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def register(self, component: str, stats):
+        """
+        Exports the counters a component already keeps.
+        :param component: the name of the component, like "policy"
+        :param stats: its stats dictionary, or a function returning one
+        :return: None
+        """
+        with self._lock:
+            self._collectors[component] = stats
+
+    def unregister(self, component: str):
+        """
+        Stops exporting the counters of a component that is gone.
+        :param component: the name it was registered with
+        :return: None
+        """
+        with self._lock:
+            self._collectors.pop(component, None)
+
+    def record_usage(self, model: str, usage, span=NOOP_SPAN):
+        """
+        Counts the prompt and completion tokens reported by a model call.
+        :param model: the model
+        :param usage: the usage of the response, it may be None
+        :param span: the span of the call, it gets the tokens as attributes
+        :return: None
+        """
+        if not self.enabled or usage is None:
+            return
+        self.count("prompt_tokens", usage.prompt_tokens, model=model)
+        self.count("completion_tokens", usage.completion_tokens, model=model)
+        span.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+
+    def _finish(self, span: Span, duration: float):
+        self.observe("stage_duration_seconds", duration, stage=span.stage)
+        if self._trace is None:
+            return
+        record = {
+            "request_id": request_id.get(),
+            "stage": span.stage,
+            "start": round(time.time() - duration, 6),
+            "duration_ms": round(duration * 1000, 3),
+            "thread": threading.current_thread().name,
+            **span.attributes,
+        }
+        line = json.dumps(record, default=str)
+        with self._lock:
+            if self._trace is not None:
+                self._trace.write(line + "\n")
+
+    def _flush_trace(self):
+        with self._lock:
+            if self._trace is not None:
+                self._trace.flush()
+
+    def snapshot(self) -> dict:
+        """
+        Current values of the counters, histograms and registered stats.
+        :return: dictionary that can be dumped as JSON
+        """
+        with self._lock:
+            counters = {self._series(name, labels): value for (name, labels), value in self._counters.items()}
+            histograms = {
+                self._series(name, labels): {"count": h["count"], "sum": round(h["sum"], 6)}
+                for (name, labels), h in self._histograms.items()
+            }
+            collectors = dict(self._collectors)
+        stats = {component: dict(stats() if callable(stats) else stats) for component, stats in collectors.items()}
+        return {"counters": counters, "histograms": histograms, "stats": stats}
+
+    @staticmethod
+    def _series(name: str, labels: tuple) -> str:
+        if not labels:
+            return name
+        rendered = ",".join(f'{key}="{str(value)}"' for key, value in labels)
+        return f"{name}{{{rendered}}}"
+
+    def render_prometheus(self) -> str:
+        """
+        Renders the metrics in the Prometheus text exposition format.
+        :return: the metrics page
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            collectors = dict(self._collectors)
+
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f"chat_{name}_total"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{self._series(metric, labels)} {value}")
+
+        for (name, labels), histogram in histograms:
+            metric = f"chat_{name}"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} histogram")
+                typed.add(metric)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float("inf"),), histogram["buckets"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self._series(metric + '_bucket', labels + (('le', le),))} {cumulative}")
+            lines.append(f"{self._series(metric + '_sum', labels)} {histogram['sum']}")
+            lines.append(f"{self._series(metric + '_count', labels)} {histogram['count']}")
+
+        if collectors:
+            lines.append("# TYPE chat_component_stat gauge")
+        for component, stats in sorted(collectors.items()):
+            values = stats() if callable(stats) else stats
+            for key, value in sorted(dict(values).items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'chat_component_stat{{component="{component}",name="{key}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+# class that serves the metrics page
+class _MetricsHandler(BaseHTTPRequestHandler):
+    telemetry: Telemetry = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            body = self.telemetry.render_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path.split("?")[0] == "/metrics.json":
+            body = json.dumps(self.telemetry.snapshot()).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# shared telemetry, configured from the environment
+telemetry = Telemetry()
@@ -0,0 +1,139 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from chat.telemetry import telemetry
+
+logger = logging.getLogger(__name__)
+
+
+# class that executes the tool calls of a model turn
+class ToolExecutor:
+    """
+    Runs the tool calls the model emits in one turn.
+    Calls with the same tool and arguments are coalesced and run once; the distinct calls run
+    concurrently on a bounded thread pool, each with the timeout of its tool. The results come
+    back as tool messages in the order of the calls, every call gets one even if its tool failed,
+    timed out or does not exist, since the API expects an answer for every tool_call_id.
+    """
+    MAX_WORKERS = int(os.getenv("TOOL_WORKERS", "4"))
+    DEFAULT_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "10"))
+
+    def __init__(self, functions: dict, timeouts: dict | None = None, max_workers: int = MAX_WORKERS, default_timeout: float = DEFAULT_TIMEOUT):
+        self.functions = functions
+        self.timeouts = timeouts or {}
+        self.default_timeout = default_timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "coalesced": 0, "errors": 0, "timeouts": 0}
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self.stats[name] += value
+
+    @staticmethod
+    def _key(tool_call) -> tuple:
+        """
+        Identifies a call by its tool and its arguments, whatever their order and spacing.
+        """
+        try:
+            arguments = json.dumps(json.loads(tool_call.function.arguments or "{}"), sort_keys=True)
+        except json.JSONDecodeError:
+            arguments = tool_call.function.arguments
+        return tool_call.function.name, arguments
+
+    def _invoke(self, name: str, arguments: str) -> dict:
+        """
+        Runs one tool, errors are returned as results so the model can see them.
+        :param name: the name of the tool
+        :param arguments: the arguments as a JSON string
+        :return: the result of the tool
+        """
+        func = self.functions.get(name)
+        telemetry.count("tool_calls", tool=name)
+        if func is None:
+            return {"status": "error", "message": f"Unknown tool: {name}"}
+        try:
+            with telemetry.span(f"tool.{name}"):
+                return func(**json.loads(arguments or "{}"))
+        except Exception as error:
+            logger.exception("tool %s failed", name)
+            self._count("errors")
+            return {"status": "error", "message": f"The tool {name} failed: {error}"}
+
+    def _timeout_result(self, name: str) -> dict:
+        self._count("timeouts")
+        logger.warning("tool %s timed out", name)
+        return {"status": "error", "message": f"The tool {name} timed out"}
+
+    def _unique(self, tool_calls: list) -> dict:
+        """
+        Groups the calls by key, keeping the first call of each group.
+        """
+        unique = {}
+        for tool_call in tool_calls:
+            unique.setdefault(self._key(tool_call), tool_call)
+        self._count("calls", len(tool_calls))
+        self._count("coalesced", len(tool_calls) - len(unique))
+        return unique
+
+    @staticmethod
+    def _messages(tool_calls: list, results: dict) -> list:
+        return [
+            {"role": "tool", "content": json.dumps(results[ToolExecutor._key(tool_call)], default=str), "tool_call_id": tool_call.id}
+            for tool_call in tool_calls
+        ]
+
+    def run(self, tool_calls: list) -> tuple[list, dict]:
+        """
+        Executes the tool calls of a turn.
+        :param tool_calls: the tool calls from the model
+        :return: the tool messages in the order of the calls, and the result of every distinct call by key
+        """
+        unique = self._unique(tool_calls)
+        started = time.monotonic()
+        futures = {
+            key: self._pool.submit(contextvars.copy_context().run, self._invoke, call.function.name, call.function.arguments)
+            for key, call in unique.items()
+        }
+        results = {}
+        for key, future in futures.items():
+            name = key[0]
+            remaining = started + self.timeouts.get(name, self.default_timeout) - time.monotonic()
+            try:
+                results[key] = future.result(timeout=max(remaining, 0))
+            except FutureTimeoutError:
+                results[key] = self._timeout_result(name)
+        return self._messages(tool_calls, results), results
+
+    async def arun(self, tool_calls: list) -> tuple[list, dict]:
+        """
+        Async version of run, the tools run on the same pool while the event loop waits.
+        """
+        unique = self._unique(tool_calls)
+        loop = asyncio.get_running_loop()
+        keys = list(unique)
+
+        async def execute(key):
+            call = unique[key]
+            timeout = self.timeouts.get(key[0], self.default_timeout)
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(
+                        self._pool,
+                        functools.partial(contextvars.copy_context().run, self._invoke, call.function.name, call.function.arguments),
+                    ),
+                    timeout,
+                )
+            except asyncio.TimeoutError:
+                return self._timeout_result(key[0])
+
+        values = await asyncio.gather(*(execute(key) for key in keys))
+        results = dict(zip(keys, values))
+        return self._messages(tool_calls, results), results
@@ -0,0 +1,223 @@
+import json
+import os
+import shutil
+import time
+from typing import List
+
+import numpy as np
+from langchain_core.documents import Document
+
+# rows converted to float32 at once when searching an int8 index
+SEARCH_BLOCK = 8192
+
+# class that implements a memory-mapped vector index
+class NumpyVectorIndex:
+    """
+    In-process vector index over normalized chunk embeddings stored in a memory-mapped .npy file.
+    Vectors are float32, or int8 with a per-row scale when quantized. The chunk ids, texts and
+    sources live in a compact table next to them (fixed-width ids, one UTF-8 blob with offsets).
+    Search is a single matrix-vector product with top-k by argpartition, and since the files
+    are opened read-only with mmap every worker process shares the same pages of the page cache.
+
+    It implements the part of the Chroma interface used by RAG and the ingestion pipeline.
+    Changes are buffered until save(), which writes a new generation of the files and switches
+    the CURRENT pointer atomically, so readers never see a half written index.
+    """
+    POINTER = "CURRENT"
+
+    def __init__(self, persist_dir: str, embedding, quantize: bool = False):
+        self.persist_dir = persist_dir
+        self.embedding = embedding
+        self.quantize = quantize
+        self._pending = {}
+        self._deleted = set()
+        self._open()
+
+    def _current_dir(self) -> str | None:
+        pointer = os.path.join(self.persist_dir, self.POINTER)
+        if not os.path.exists(pointer):
+            return None
+        with open(pointer, "r", encoding="utf-8") as f:
+            return os.path.join(self.persist_dir, f.read().strip())
+
+    def _open(self):
+        """
+        Memory-maps the current generation of the index.
+        :return: None
+        """
+        generation = self._current_dir()
+        if generation is None:
+            self.vectors = np.zeros((0, 0), dtype=np.float32)
+            self.scales = None
+            self.ids = np.zeros(0, dtype="S32")
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.texts = np.zeros(0, dtype=np.uint8)
+            self.source_index = np.zeros(0, dtype=np.int32)
+            self.sources = []
+        else:
+            self.vectors = np.load(os.path.join(generation, "vectors.npy"), mmap_mode="r")
+            scales_path = os.path.join(generation, "scales.npy")
+            self.scales = np.load(scales_path, mmap_mode="r") if os.path.exists(scales_path) else None
+            self.ids = np.load(os.path.join(generation, "ids.npy"), mmap_mode="r")
+            self.offsets = np.load(os.path.join(generation, "offsets.npy"), mmap_mode="r")
+            self.texts = np.load(os.path.join(generation, "texts.npy"), mmap_mode="r")
+            self.source_index = np.load(os.path.join(generation, "source_index.npy"), mmap_mode="r")
+            with open(os.path.join(generation, "sources.json"), "r", encoding="utf-8") as f:
+                self.sources = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Size of the index files, which is what the index can take in memory.
+        """
+        total = self.vectors.nbytes + self.ids.nbytes + self.offsets.nbytes + self.texts.nbytes + self.source_index.nbytes
+        return total + (self.scales.nbytes if self.scales is not None else 0)
+
+    def _text(self, row: int) -> str:
+        return bytes(self.texts[self.offsets[row]:self.offsets[row + 1]]).decode("utf-8")
+
+    def _vector(self, row: int) -> np.ndarray:
+        vector = np.asarray(self.vectors[row], dtype=np.float32)
+        return vector * self.scales[row] if self.scales is not None else vector
+
+    @staticmethod
+    def _normalize(vectors) -> np.ndarray:
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def add_texts(self, texts: List[str], metadatas: List[dict] | None = None, ids: List[str] | None = None) -> List[str]:
+        """
+        Embeds texts and buffers them until save().
+        :param texts: the chunk texts
+        :param metadatas: the metadata of each chunk, only "source" is kept
+        :param ids: the chunk ids
+        :return: the ids
+        """
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = self._normalize(self.embedding.embed_documents(list(texts)))
+        for id_, text, metadata, vector in zip(ids, texts, metadatas, vectors):
+            self._pending[id_] = (text, metadata.get("source", ""), vector)
+            self._deleted.discard(id_)
+        return list(ids)
+
+    def delete(self, ids: List[str] | None = None):
+        """
+        Buffers the deletion of chunks until save().
+        :param ids: the chunk ids
+        :return: None
+        """
+        for id_ in ids or []:
+            self._pending.pop(id_, None)
+            self._deleted.add(id_)
+
+    def get(self, include: List[str] | None = None) -> dict:
+        """
+        Returns the stored chunks, in the shape Chroma returns them.
+        :param include: add "documents" and/or "metadatas" to get them too
+        :return: dictionary with the ids and the requested fields
+        """
+        include = ["metadatas", "documents"] if include is None else include
+        result = {"ids": [id_.decode("ascii") for id_ in self.ids]}
+        if "documents" in include:
+            result["documents"] = [self._text(row) for row in range(len(self))]
+        if "metadatas" in include:
+            result["metadatas"] = [
+                {"source": self.sources[self.source_index[row]], "chunk_id": result["ids"][row]} for row in range(len(self))
+            ]
+        return result
+
+    def save(self):
+        """
+        Writes a new generation with the buffered changes and maps it.
+        :return: None
+        """
+        if not self._pending and not self._deleted:
+            return
+        keep = [
+            row for row, id_ in enumerate(self.ids)
+            if id_.decode("ascii") not in self._deleted and id_.decode("ascii") not in self._pending
+        ]
+        ids = [self.ids[row].decode("ascii") for row in keep] + list(self._pending)
+        texts = [self._text(row) for row in keep] + [text for text, _, _ in self._pending.values()]
+        sources = [self.sources[self.source_index[row]] for row in keep] + [source for _, source, _ in self._pending.values()]
+        dim = self.vectors.shape[1] if len(keep) else (next(iter(self._pending.values()))[2].shape[0] if self._pending else 0)
+        vectors = np.zeros((len(ids), dim), dtype=np.float32)
+        for i, row in enumerate(keep):
+            vectors[i] = self._vector(row)
+        for i, (_, _, vector) in enumerate(self._pending.values(), start=len(keep)):
+            vectors[i] = vector
+
+        generation = f"gen-{time.time_ns()}"
+        path = os.path.join(self.persist_dir, generation)
+        os.makedirs(path, exist_ok=True)
+        if self.quantize:
+            scales = np.abs(vectors).max(axis=1) / 127.0 if len(ids) else np.zeros(0, dtype=np.float32)
+            scales[scales == 0] = 1.0
+            np.save(os.path.join(path, "vectors.npy"), np.round(vectors / scales[:, None]).astype(np.int8))
+            np.save(os.path.join(path, "scales.npy"), scales.astype(np.float32))
+        else:
+            np.save(os.path.join(path, "vectors.npy"), vectors)
+        encoded = [text.encode("utf-8") for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(text) for text in encoded])
+        np.save(os.path.join(path, "ids.npy"), np.array(ids, dtype="S32"))
+        np.save(os.path.join(path, "offsets.npy"), offsets)
+        np.save(os.path.join(path, "texts.npy"), np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        unique_sources = sorted(set(sources))
+        lookup = {source: i for i, source in enumerate(unique_sources)}
+        np.save(os.path.join(path, "source_index.npy"), np.array([lookup[s] for s in sources], dtype=np.int32))
+        with open(os.path.join(path, "sources.json"), "w", encoding="utf-8") as f:
+            json.dump(unique_sources, f)
+
+        previous = self._current_dir()
+        pointer = os.path.join(self.persist_dir, self.POINTER)
+        with open(f"{pointer}.tmp", "w", encoding="utf-8") as f:
+            f.write(generation)
+        os.replace(f"{pointer}.tmp", pointer)
+        # the previous generation stays for processes that are opening it right now, older ones go;
+        # processes that still map deleted files keep them until they reopen
+        keep_dirs = {generation, os.path.basename(previous) if previous else None}
+        for name in os.listdir(self.persist_dir):
+            if name.startswith("gen-") and name not in keep_dirs:
+                shutil.rmtree(os.path.join(self.persist_dir, name), ignore_errors=True)
+
+        self._pending = {}
+        self._deleted = set()
+        self._open()
+
+    def search(self, embedding, k: int = 4) -> list[tuple[str, str, float]]:
+        """
+        Finds the chunks closest to a query vector.
+        :param embedding: the query vector
+        :param k: number of chunks to return
+        :return: list of (chunk id, text, cosine similarity), best first
+        """
+        n = len(self)
+        if n == 0:
+            return []
+        query = self._normalize(embedding)[0]
+        if self.scales is None:
+            scores = self.vectors @ query
+        else:
+            scores = np.empty(n, dtype=np.float32)
+            for start in range(0, n, SEARCH_BLOCK):
+                block = np.asarray(self.vectors[start:start + SEARCH_BLOCK], dtype=np.float32)
+                scores[start:start + SEARCH_BLOCK] = (block @ query) * self.scales[start:start + SEARCH_BLOCK]
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[row].decode("ascii"), self._text(row), float(scores[row])) for row in top]
+
+    def similarity_search_by_vector(self, embedding, k: int = 4) -> List[Document]:
+        """
+        Same as search, returned as documents like Chroma does.
+        """
+        return [
+            Document(page_content=text, metadata={"chunk_id": id_, "score": score})
+            for id_, text, score in self.search(embedding, k)
+        ]